@@ -0,0 +1,244 @@
+"""
+bench.py
+
+Benchmarks for playlists.py on synthetic iTunes library exports.
+
+A library of the requested size is generated (with a controllable share of
+duplicate tracks and of tracks missing fields), then parsing, duplicate
+detection, playlist intersection and statistics are timed separately, as is
+holding all tracks in memory as dicts and as TrackRecords. Wall
+time and peak traced memory of each stage go into a JSON report, which can
+be compared against the report of an earlier run.
+
+    python bench.py --tracks 100000 --out after.json --compare before.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from duplicates import find_duplicate_groups
+from plistreader import iter_tracks
+from stats import compute_stats, table_chunks
+from tracktable import load_table
+
+WORDS = ("love night heart time light fire rain dream blue river road home moon "
+         "song dance world sky sea gold star wind girl boy city summer winter "
+         "soul baby black white sweet wild lost free run fall rise").split()
+GENRES = ['Rock', 'Pop', 'Jazz', 'Blues', 'Classical', 'Hip-Hop', 'Electronic', 'Folk']
+
+XML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+\t<key>Major Version</key><integer>1</integer>
+\t<key>Minor Version</key><integer>1</integer>
+\t<key>Application Version</key><string>12.0</string>
+\t<key>Tracks</key>
+\t<dict>
+"""
+
+
+def _title(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).title()
+
+
+def generate_library(path, tracks, dup_rate=0.05, missing_rate=0.02, playlists=10,
+                     seed=0):
+    """Write a synthetic library export with the given number of tracks.
+
+    dup_rate is the share of tracks that copy the name, artist, album and
+    (to the second) duration of an earlier track; missing_rate is the chance
+    of each of Artist, Total Time and Album Rating being left out.
+    """
+    rng = random.Random(seed)
+    artists = [_title(rng, 2) for _ in range(max(tracks // 50, 1))]
+    albums = [_title(rng, 3) for _ in range(max(tracks // 10, 1))]
+    originals = []
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(XML_HEADER)
+        for track_id in range(1, tracks + 1):
+            if originals and rng.random() < dup_rate:
+                name, artist, album, duration = rng.choice(originals)
+                duration += rng.randrange(0, 1000 - duration % 1000)
+            else:
+                name, artist, album = _title(rng, rng.randint(1, 4)), \
+                    rng.choice(artists), rng.choice(albums)
+                duration = int(rng.lognormvariate(12.4, 0.35))
+                if len(originals) < 100000:
+                    originals.append((name, artist, album, duration))
+            lines = [f"\t\t<key>{track_id}</key>\n\t\t<dict>\n",
+                     f"\t\t\t<key>Track ID</key><integer>{track_id}</integer>\n",
+                     f"\t\t\t<key>Name</key><string>{escape(name)}</string>\n"]
+            if rng.random() >= missing_rate:
+                lines.append(f"\t\t\t<key>Artist</key><string>{escape(artist)}</string>\n")
+            lines.append(f"\t\t\t<key>Album</key><string>{escape(album)}</string>\n")
+            lines.append(f"\t\t\t<key>Genre</key><string>{rng.choice(GENRES)}</string>\n")
+            if rng.random() >= missing_rate:
+                lines.append(f"\t\t\t<key>Total Time</key><integer>{duration}</integer>\n")
+            lines.append(f"\t\t\t<key>Year</key><integer>{rng.randint(1960, 2020)}</integer>\n")
+            lines.append(f"\t\t\t<key>Date Added</key><date>20{rng.randint(10, 20)}-"
+                         f"{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00Z</date>\n")
+            if rng.random() >= missing_rate:
+                lines.append("\t\t\t<key>Album Rating</key>"
+                             f"<integer>{rng.randint(0, 5) * 20}</integer>\n")
+            lines.append("\t\t\t<key>Persistent ID</key>"
+                         f"<string>{rng.getrandbits(64):016X}</string>\n\t\t</dict>\n")
+            f.write(''.join(lines))
+        f.write("\t</dict>\n\t<key>Playlists</key>\n\t<array>\n")
+        size = max(min(tracks // 10, 50000), 1)
+        for number in range(playlists):
+            items = sorted(rng.sample(range(1, tracks + 1), min(size, tracks)))
+            f.write(f"\t\t<dict>\n\t\t\t<key>Name</key><string>Playlist {number}</string>\n"
+                    f"\t\t\t<key>Playlist ID</key><integer>{100000 + number}</integer>\n"
+                    "\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n")
+            f.write(''.join("\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key>"
+                            f"<integer>{item}</integer>\n\t\t\t\t</dict>\n" for item in items))
+            f.write("\t\t\t</array>\n\t\t</dict>\n")
+        f.write("\t</array>\n</dict>\n</plist>\n")
+
+
+def measure(func, repeat=1, memory=True):
+    """Run func, return (result, best wall time in s, peak traced MB or None).
+
+    Peak memory is measured in a separate run under tracemalloc, which would
+    otherwise distort the timings.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def intersect_playlists(table):
+    """Intersect all playlists of a table's library, smallest first."""
+    arrays = sorted((table.playlists.track_ids(i) for i in table.playlists.selectable()),
+                    key=len)
+    if not arrays:
+        return np.zeros(0, np.int32)
+    common = arrays[0]
+    for track_ids in arrays[1:]:
+        common = np.intersect1d(common, track_ids, assume_unique=True)
+    return common
+
+
+def run_benchmarks(xml_path, repeat=1, memory=True):
+    """Time each stage on an export; return {stage: {seconds, peak_mb}}."""
+    results = {}
+
+    def record(stage, func):
+        result, seconds, peak = measure(func, repeat, memory)
+        results[stage] = {'seconds': round(seconds, 4),
+                          'peak_mb': None if peak is None else round(peak, 2)}
+        print(f"{stage:>12}: {seconds:8.3f} s" +
+              ('' if peak is None else f"  {peak:8.1f} MB peak"))
+        return result
+
+    table = record('parse', lambda: load_table(xml_path, use_cache=False))
+    # Write the cache once, then time loading it back
+    load_table(xml_path)
+    record('cache_load', lambda: len(load_table(xml_path).name.values))
+    record('duplicates', lambda: find_duplicate_groups(table))
+    record('intersection', lambda: intersect_playlists(table))
+    record('stats', lambda: compute_stats(table_chunks(table)))
+    # Whole library held in memory: one dict per track (as plistlib gives)
+    # against compact TrackRecords
+    record('track_dicts', lambda: len(list(iter_tracks(xml_path))))
+    record('track_records', lambda: len(list(table.records())))
+    if memory and results['track_records']['peak_mb']:
+        ratio = results['track_dicts']['peak_mb'] / results['track_records']['peak_mb']
+        print(f"{'':>12}  records use {ratio:.1f}x less memory than dicts")
+    return results
+
+
+def compare_reports(old, new):
+    """Print the change of each stage between two reports."""
+    print(f"{'stage':>12}  {'old s':>9} {'new s':>9} {'ratio':>7}  {'old MB':>8} {'new MB':>8}")
+    for stage, now in new['results'].items():
+        before = old['results'].get(stage)
+        if before is None:
+            continue
+        ratio = now['seconds'] / before['seconds'] if before['seconds'] else float('nan')
+        peaks = ['-' if peak is None else f"{peak:.1f}"
+                 for peak in (before['peak_mb'], now['peak_mb'])]
+        print(f"{stage:>12}  {before['seconds']:9.3f} {now['seconds']:9.3f} {ratio:7.2f}  "
+              f"{peaks[0]:>8} {peaks[1]:>8}")
+
+
+def max_rss_mb():
+    """Peak resident memory of this process in MB, None where unknown."""
+    try:
+        # Not available on Windows
+        import resource
+    except ImportError:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def main():
+    """Generate a library and benchmark playlists.py on it."""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks playlists.py on a synthetic iTunes library.")
+    parser.add_argument('--tracks', type=int, default=100000)
+    parser.add_argument('--dup-rate', dest='dup_rate', type=float, default=0.05)
+    parser.add_argument('--missing-rate', dest='missing_rate', type=float, default=0.02)
+    parser.add_argument('--playlists', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="Keep the best of N timings")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="Skip the tracemalloc peak memory runs")
+    parser.add_argument('--xml', help="Keep the generated library here (reused if it exists)")
+    parser.add_argument('--out', default='bench.json', help="JSON report to write")
+    parser.add_argument('--compare', help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name)
+              for name in ('tracks', 'dup_rate', 'missing_rate', 'playlists', 'seed')}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        xml_path = args.xml or os.path.join(tmp_dir, 'library.xml')
+        if not os.path.exists(xml_path):
+            print(f"generating {args.tracks} tracks...")
+            start = time.perf_counter()
+            generate_library(xml_path, **config)
+            print(f"generated {os.path.getsize(xml_path) / 2**20:.1f} MB "
+                  f"in {time.perf_counter() - start:.1f} s")
+        results = run_benchmarks(xml_path, args.repeat, args.memory)
+
+    report = {
+        'config': config,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'max_rss_mb': max_rss_mb(),
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"report written to {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+duplicates.py
+
+Duplicate detection over a TrackTable.
+
+Tracks are grouped on a key (name, name+artist or name+artist+album) and on
+their duration in whole seconds. Grouping is a single NumPy lexsort over the
+interned string codes and the duration buckets, so it scales to millions of
+tracks without a Python loop per track. Names can optionally be matched
+fuzzily (see fuzzy.py).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from fuzzy import fuzzy_title_clusters
+from tracktable import MISSING
+
+# Key name -> string columns that make up the key
+DUP_KEYS = {
+    'name': ('name',),
+    'name+artist': ('name', 'artist'),
+    'name+artist+album': ('name', 'artist', 'album'),
+}
+
+# Width of a duration bucket in milliseconds
+DURATION_BUCKET = 1000
+
+# key: tuple of the key's strings (None where a field is missing)
+# duration: the duration bucket in seconds
+# track_ids: Track IDs of every copy
+DuplicateGroup = namedtuple('DuplicateGroup', ['key', 'duration', 'track_ids'])
+
+
+def group_boundaries(columns):
+    """Start index and size of each run of equal rows in sorted columns."""
+    count = len(columns[0])
+    change = np.zeros(count, bool)
+    if count == 0:
+        return np.zeros(0, np.intp), np.zeros(0, np.intp)
+    change[0] = True
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+    starts = np.flatnonzero(change)
+    sizes = np.diff(np.append(starts, count))
+    return starts, sizes
+
+
+def find_duplicate_groups(table, key='name', bucket=DURATION_BUCKET, fuzzy=None):
+    """Return every group of tracks sharing a key and duration bucket.
+
+    With fuzzy set to a similarity threshold, names are matched with
+    fuzzy.fuzzy_title_clusters instead of exactly. Groups are ordered by
+    size, largest first.
+    """
+    fields = DUP_KEYS[key]
+    # Tracks without a name or duration can't be matched
+    valid = (table.name.codes != MISSING) & (table.total_time != MISSING)
+    rows = np.flatnonzero(valid)
+    columns = [np.asarray(table.strings[field].codes)[rows] for field in fields]
+    if fuzzy is not None:
+        # Replace name codes with the label of their near-duplicate cluster
+        columns[0] = fuzzy_title_clusters(table.name.values, fuzzy)[columns[0]]
+    columns.append(np.asarray(table.total_time)[rows] // bucket)
+    # lexsort sorts on its last key first
+    order = np.lexsort(columns[::-1])
+    columns = [column[order] for column in columns]
+    rows = rows[order]
+
+    starts, sizes = group_boundaries(columns)
+    dup = sizes > 1
+    starts, sizes = starts[dup], sizes[dup]
+    # Largest groups first, ties in sort order
+    by_size = np.argsort(-sizes, kind='stable')
+    track_ids = np.asarray(table.track_id)
+    groups = []
+    for start, size in zip(starts[by_size].tolist(), sizes[by_size].tolist()):
+        group_key = tuple(table.strings[field][rows[start]] for field in fields)
+        duration = int(columns[-1][start]) * bucket // 1000
+        groups.append(DuplicateGroup(group_key, duration,
+                                     track_ids[rows[start:start + size]]))
+    return groups
+
+
+def changed_keys(table, rows, key='name'):
+    """Set of key tuples of the given rows of a table."""
+    fields = DUP_KEYS[key]
+    columns = [table.strings[field] for field in fields]
+    return {tuple(column[row] for column in columns) for row in np.asarray(rows).tolist()}
+
+
+def update_duplicate_groups(groups, table, changed, key='name', bucket=DURATION_BUCKET):
+    """Bring duplicate groups up to date after the tracks of some keys changed.
+
+    groups were computed on an earlier version of the library and table is
+    the new version; changed holds the key tuples of every added, removed
+    or modified track. Only tracks sharing a name with a changed key are
+    grouped again, all other groups are kept as they are.
+    """
+    kept = [group for group in groups if group.key not in changed]
+    names = {group_key[0] for group_key in changed}
+    codes = [code for code, value in enumerate(table.name.values) if value in names]
+    rows = np.flatnonzero(np.isin(table.name.codes, codes))
+    fresh = [group for group in find_duplicate_groups(table.take(rows), key, bucket)
+             if group.key in changed]
+    return sorted(kept + fresh, key=lambda group: -len(group.track_ids))
+
+
+def groups_to_state(groups):
+    """Duplicate groups as JSON-serializable data, see groups_from_state."""
+    return [[list(group.key), group.duration, group.track_ids.tolist()] for group in groups]
+
+
+def groups_from_state(state):
+    """Rebuild duplicate groups saved with groups_to_state."""
+    return [DuplicateGroup(tuple(key), duration, np.array(track_ids, np.int32))
+            for key, duration, track_ids in state]
@@ -0,0 +1,188 @@
+"""
+fuzzy.py
+
+Near-duplicate matching of track titles.
+
+Titles are normalized (case, accents, punctuation and bracketed qualifiers
+such as "(Remastered)" are dropped) and then compared on their character
+trigrams. Rather than comparing every pair of titles, a MinHash signature is
+computed for each title and split into bands (locality sensitive hashing);
+only titles that share a band bucket are compared, which keeps the work
+close to linear in the number of titles.
+"""
+
+import re
+import unicodedata
+
+import numpy as np
+
+# Default trigram Jaccard similarity for two titles to match
+FUZZY_THRESHOLD = 0.75
+
+# MinHash signature length, split into BANDS bands of NUM_PERM/BANDS rows.
+# With 8 bands of 4 rows, pairs at the default threshold are found ~95% of
+# the time while pairs below ~0.5 rarely become candidates.
+NUM_PERM = 32
+BANDS = 8
+
+# Buckets larger than this are only compared against their first title
+MAX_BUCKET = 100
+
+# Candidates whose MinHash estimate is this far below the threshold are
+# dropped without computing their exact similarity
+ESTIMATE_SLACK = 0.2
+
+_BRACKETS = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+_SUFFIX = re.compile(r'\s-\s.*\b(remaster(ed)?|live|version|edit|mix|mono|stereo)\b.*$')
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_title(title):
+    """Reduce a title to a canonical form for matching."""
+    text = title
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = text.lower()
+    stripped = _SUFFIX.sub('', _BRACKETS.sub(' ', text))
+    # Keep the bracketed text if it was the whole title, e.g. "(Intro)"
+    if stripped.strip():
+        text = stripped
+    text = _PUNCTUATION.sub('', text.replace('&', ' and '))
+    return _SPACES.sub(' ', text).strip()
+
+
+def trigrams(title):
+    """Set of character trigrams of a normalized title."""
+    padded = f' {title} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _mix(values, seed):
+    """Hash uint64 values with a splitmix64 style finalizer."""
+    h = values ^ np.uint64(seed)
+    h *= np.uint64(0xbf58476d1ce4e5b9)
+    h ^= h >> np.uint64(31)
+    h *= np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(29)
+    return h
+
+
+def minhash_signatures(titles, num_perm=NUM_PERM):
+    """MinHash signatures (len(titles) x num_perm) of trigram sets.
+
+    All trigrams of all titles are built as one array, so the work is a few
+    NumPy passes rather than a Python loop per trigram. Rows of titles with
+    no trigrams are left at the maximum value.
+    """
+    signatures = np.full((len(titles), num_perm), np.iinfo(np.uint64).max, np.uint64)
+    if not titles:
+        return signatures
+    # Titles padded with spaces and separated by NUL as UTF-32 code points
+    text = '\0'.join(f' {title} ' for title in titles) + '\0'
+    chars = np.frombuffer(text.encode('utf-32-le'), np.uint32).astype(np.uint64)
+    codes = (chars[:-2] << np.uint64(42)) | (chars[1:-1] << np.uint64(21)) | chars[2:]
+    # A trigram is valid when it doesn't span a separator
+    valid = (chars[:-2] != 0) & (chars[1:-1] != 0) & (chars[2:] != 0)
+    owners = np.cumsum(chars == 0)[:-2][valid]
+    codes = codes[valid]
+    if len(codes) == 0:
+        return signatures
+    # Trigrams are contiguous per title, reduce over each title's run
+    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    rows = owners[starts]
+    with np.errstate(over='ignore'):
+        hashed = _mix(codes, 0)
+        # Each permutation is a cheap multiply-add of the base hash
+        multipliers = _mix(np.arange(1, num_perm + 1, dtype=np.uint64), 1) | np.uint64(1)
+        offsets = _mix(np.arange(1, num_perm + 1, dtype=np.uint64), 2)
+        for i in range(num_perm):
+            permuted = hashed * multipliers[i] + offsets[i]
+            signatures[rows, i] = np.minimum.reduceat(permuted, starts)
+    return signatures
+
+
+def candidate_pairs(signatures, bands=BANDS):
+    """Return (a, b) arrays of row pairs sharing at least one LSH band bucket."""
+    count, num_perm = signatures.shape
+    rows_per_band = num_perm // bands
+    firsts, seconds = [], []
+    for band in range(bands):
+        part = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        # Collapse the band to one hash per title and sort into buckets
+        with np.errstate(over='ignore'):
+            keys = np.zeros(count, np.uint64)
+            for column in part.T:
+                keys = _mix(keys ^ column, band)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        change = np.r_[True, keys[1:] != keys[:-1]]
+        starts = np.flatnonzero(change)
+        sizes = np.diff(np.append(starts, count))
+        # Bucket and bucket size of every position in sorted order
+        bucket = np.cumsum(change) - 1
+        size = sizes[bucket]
+        # Small buckets: every pair, found as positions k apart in one bucket
+        small = np.flatnonzero((size > 1) & (size <= MAX_BUCKET))
+        for k in range(1, sizes[sizes <= MAX_BUCKET].max(initial=1)):
+            small = small[size[small] > k]
+            small = small[small + k < count]
+            same = small[bucket[small] == bucket[small + k]]
+            firsts.append(order[same])
+            seconds.append(order[same + k])
+        # Large buckets: every member against the bucket's first one
+        large = np.flatnonzero(size > MAX_BUCKET)
+        large = large[~change[large]]
+        firsts.append(order[starts[bucket[large]]])
+        seconds.append(order[large])
+    a, b = np.concatenate(firsts), np.concatenate(seconds)
+    # Order each pair and drop pairs found in more than one band
+    pairs = np.unique(np.minimum(a, b) * np.int64(count) + np.maximum(a, b))
+    return pairs // count, pairs % count
+
+
+def fuzzy_title_clusters(titles, threshold=FUZZY_THRESHOLD):
+    """Cluster titles that are near-duplicates of each other.
+
+    Returns an int array giving a cluster label for each title; titles with
+    the same label match. Labels are indices into titles.
+    """
+    # Titles that normalize to the same text match outright
+    normalized = {}
+    labels = np.empty(len(titles), np.int32)
+    for index, title in enumerate(titles):
+        labels[index] = normalized.setdefault(normalize_title(title), index)
+    unique = list(normalized)
+    # Union-find over the unique normalized titles
+    parent = list(range(len(unique)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    signatures = minhash_signatures(unique)
+    first, second = candidate_pairs(signatures)
+    # The share of equal signature values estimates the similarity; drop
+    # candidates that are clearly below the threshold before the exact check
+    estimate = (signatures[first] == signatures[second]).mean(axis=1)
+    keep = estimate >= threshold - ESTIMATE_SLACK
+    shingles = {}
+    for a, b in zip(first[keep].tolist(), second[keep].tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a == root_b:
+            continue
+        # Verify the candidate on its exact trigram similarity
+        for i in (a, b):
+            if i not in shingles:
+                shingles[i] = trigrams(unique[i])
+        union = len(shingles[a] | shingles[b])
+        if union and len(shingles[a] & shingles[b]) / union >= threshold:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    # Map each title to the representative of its cluster
+    representative = np.array([normalized[unique[find(i)]] for i in range(len(unique))],
+                              np.int32)
+    position = {index: i for i, index in enumerate(normalized.values())}
+    return representative[[position[label] for label in labels.tolist()]]
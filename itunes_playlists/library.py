@@ -0,0 +1,212 @@
+"""
+library.py
+
+Python API over an iTunes export.
+
+A Library loads an export once and answers duplicates, common tracks,
+statistics and report queries with plain data structures instead of
+printing and writing files, so a long-running process can keep libraries
+warm in memory:
+
+    from library import Library
+
+    music = Library('mymusic.xml')
+    groups = music.duplicates(key='name+artist')
+    shared = music.common_with(Library('other.xml'))
+    print(music.stats().to_dict())
+
+Everything is loaded lazily: the track table is only read (memory mapped
+from its cache when valid) on the first query that needs it, a string
+field's values are only decoded when asked for, and results are computed
+once per set of arguments.
+"""
+
+import os
+
+import numpy as np
+
+from duplicates import (DURATION_BUCKET, find_duplicate_groups, groups_from_state,
+                        groups_to_state)
+from fuzzy import fuzzy_title_clusters
+from overlap import PlaylistSets
+from report import run_report
+from resultcache import load_results, save_results
+from stats import TrackStats, compute_stats, table_chunks
+from tracktable import MISSING, load_table
+
+
+def table_track_names(table, rows=None):
+    """Return the set of track names of a table (or of some of its rows)."""
+    codes = np.asarray(table.name.codes)
+    if rows is not None:
+        codes = codes[rows]
+    # Interned names of the tracks that have one
+    codes = np.unique(codes)
+    codes = codes[codes != MISSING]
+    values = table.name.values
+    return frozenset(values[code] for code in codes.tolist())
+
+
+def intersect_smallest_first(sets):
+    """Intersect sets starting from the smallest one."""
+    sets = sorted(sets, key=len)
+    common = set(sets[0])
+    for other in sets[1:]:
+        if not common:
+            break
+        common.intersection_update(other)
+    return common
+
+
+def merge_fuzzy_names(track_names_sets, fuzzy):
+    """Replace each name by the representative of its near-duplicate cluster."""
+    titles = list(set().union(*track_names_sets))
+    labels = fuzzy_title_clusters(titles, fuzzy).tolist()
+    representative = {title: titles[label] for title, label in zip(titles, labels)}
+    return [frozenset(representative[name] for name in names)
+            for names in track_names_sets]
+
+
+class Library:
+    """An iTunes export loaded once and queried many times."""
+
+    def __init__(self, file_name, use_cache=True):
+        self.file_name = file_name
+        self.use_cache = use_cache
+        st = os.stat(file_name)
+        # Version of the export this object describes, see is_stale
+        self.source = (st.st_size, st.st_mtime_ns)
+        self._table = None
+        self._fields = {}
+        self._results = {}
+
+    def __repr__(self):
+        return f"Library({self.file_name!r})"
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def table(self):
+        """The TrackTable of the export, loaded on first use."""
+        if self._table is None:
+            self._table = load_table(self.file_name, self.use_cache)
+        return self._table
+
+    def is_stale(self):
+        """True once the export on disk has changed since it was loaded."""
+        try:
+            st = os.stat(self.file_name)
+        except OSError:
+            return True
+        return (st.st_size, st.st_mtime_ns) != self.source
+
+    def field(self, name):
+        """Values of one field for every track as a list (None if missing).
+
+        Only the requested field is materialized, and only once.
+        """
+        if name not in self._fields:
+            column = getattr(self.table, name)
+            self._fields[name] = list(column) if name in self.table.strings else \
+                [None if value == MISSING else value for value in column.tolist()]
+        return self._fields[name]
+
+    def _cached(self, key, compute):
+        if key not in self._results:
+            self._results[key] = compute()
+        return self._results[key]
+
+    def duplicates(self, key='name', fuzzy=None, bucket=DURATION_BUCKET):
+        """Duplicate groups (see duplicates.DuplicateGroup), largest first."""
+        def compute():
+            exact = fuzzy is None and bucket == DURATION_BUCKET
+            cached = load_results(self.file_name).get('dups', {}) \
+                if self.use_cache and exact else {}
+            if cached.get('key') == key:
+                # Reuse the groups of an earlier run (or of --diff)
+                return groups_from_state(cached['groups'])
+            groups = find_duplicate_groups(self.table, key, bucket, fuzzy)
+            if self.use_cache and exact:
+                save_results(self.file_name,
+                             dups={'key': key, 'groups': groups_to_state(groups)})
+            return groups
+        return self._cached(('duplicates', key, fuzzy, bucket), compute)
+
+    def stats(self):
+        """TrackStats of the durations and ratings of all tracks."""
+        def compute():
+            cached = load_results(self.file_name).get('stats') if self.use_cache else None
+            if cached:
+                return TrackStats.from_state(cached)
+            stats = compute_stats(table_chunks(self.table))
+            if self.use_cache:
+                save_results(self.file_name, stats=stats.to_state())
+            return stats
+        return self._cached(('stats',), compute)
+
+    def report(self, analyzers=None, dup_key='name'):
+        """Health report data, see report.run_report."""
+        names = tuple(analyzers) if analyzers else None
+        return self._cached(('report', names, dup_key),
+                            lambda: run_report(self.table, names, dup_key))
+
+    def track_names(self):
+        """Frozen set of the names of all tracks."""
+        return self._cached(('track_names',), lambda: table_track_names(self.table))
+
+    def playlist_names(self):
+        """Names of the playlists of the export, except the whole-library one."""
+        index = self.table.playlists
+        return [index.names[i] for i in index.selectable()]
+
+    def playlists_of(self, track_id):
+        """Names of the playlists containing a track, except the whole-library one."""
+        index = self.table.playlists
+        return [index.names[i] for i in index.playlists_of(track_id) if not index.master[i]]
+
+    def playlist_track_ids(self, selection=None):
+        """(names, sorted Track ID arrays) of playlists of the export.
+
+        Without a selection (playlist names or IDs) all playlists but the
+        whole-library one are returned; unknown names raise KeyError.
+        """
+        index = self.table.playlists
+        positions = [index.find(name) for name in selection] if selection \
+            else index.selectable()
+        return [index.names[i] for i in positions], [index.track_ids(i) for i in positions]
+
+    def common_with(self, *others, fuzzy=None):
+        """Sorted names of the tracks found in this and all other libraries."""
+        name_sets = [library.track_names() for library in (self,) + others]
+        if fuzzy is not None:
+            name_sets = merge_fuzzy_names(name_sets, fuzzy)
+        return sorted(intersect_smallest_first(name_sets))
+
+    def common_in_playlists(self, selection=None, fuzzy=None):
+        """Sorted names of the tracks found in all (or the selected) playlists.
+
+        Raises ValueError when fewer than two playlists are compared.
+        """
+        _, arrays = self.playlist_track_ids(selection)
+        if len(arrays) < 2:
+            raise ValueError(f"Need at least two playlists in {self.file_name}")
+        if fuzzy is None:
+            # Intersect the sorted Track ID arrays, smallest first
+            arrays = sorted(arrays, key=len)
+            common_ids = arrays[0]
+            for track_ids in arrays[1:]:
+                common_ids = np.intersect1d(common_ids, track_ids, assume_unique=True)
+            return sorted(table_track_names(self.table, self.table.rows_of(common_ids)))
+        name_sets = [table_track_names(self.table, self.table.rows_of(track_ids))
+                     for track_ids in arrays]
+        return sorted(intersect_smallest_first(merge_fuzzy_names(name_sets, fuzzy)))
+
+    def playlist_overlap(self, selection=None, fuzzy=None):
+        """PlaylistSets of all (or the selected) playlists of the export."""
+        labels, arrays = self.playlist_track_ids(selection)
+        if fuzzy is None:
+            return PlaylistSets.from_track_ids(labels, arrays)
+        name_sets = [table_track_names(self.table, self.table.rows_of(track_ids))
+                     for track_ids in arrays]
+        return PlaylistSets.from_name_sets(labels, merge_fuzzy_names(name_sets, fuzzy))
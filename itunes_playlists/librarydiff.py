@@ -0,0 +1,41 @@
+"""
+librarydiff.py
+
+Differences between two exports of the same library.
+
+Tracks are matched on their Persistent ID (Track ID when there is none) and
+compared on the fingerprint stored in the track table, so finding what was
+added, removed or modified is a handful of sorted-array operations.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+# Row indices: added (new table), removed (old table) and modified tracks,
+# matched pairwise between modified_old and modified_new
+LibraryDiff = namedtuple('LibraryDiff',
+                         ['added', 'removed', 'modified_old', 'modified_new'])
+
+
+def diff_tables(old, new):
+    """Compare two TrackTables and return a LibraryDiff."""
+    old_keys, new_keys = old.keys(), new.keys()
+    _, old_rows, new_rows = np.intersect1d(old_keys, new_keys, assume_unique=True,
+                                           return_indices=True)
+    removed = np.setdiff1d(np.arange(len(old)), old_rows, assume_unique=True)
+    added = np.setdiff1d(np.arange(len(new)), new_rows, assume_unique=True)
+    modified = (np.asarray(old.fingerprint)[old_rows]
+                != np.asarray(new.fingerprint)[new_rows])
+    # Report modified tracks in the order they appear in the new export
+    order = np.argsort(new_rows[modified])
+    return LibraryDiff(added, removed, old_rows[modified][order], new_rows[modified][order])
+
+
+def update_stats(stats, old, new, diff):
+    """Update TrackStats of the old table to describe the new one."""
+    for table, rows, sign in ((old, diff.removed, -1), (old, diff.modified_old, -1),
+                              (new, diff.added, 1), (new, diff.modified_new, 1)):
+        stats.update(np.asarray(table.total_time)[rows],
+                     np.asarray(table.album_rating)[rows], sign)
+    return stats
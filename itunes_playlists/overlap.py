@@ -0,0 +1,127 @@
+"""
+overlap.py
+
+Set algebra across many playlists.
+
+Every distinct track (by name, or by Track ID for the playlists of a single
+library export) gets an integer ID. Each playlist is then held both
+as a sorted array of IDs (for unions, differences and per-track counts) and
+as a row of a packed bitset matrix, so the pairwise intersection sizes of all
+playlists come from one AND + popcount pass per playlist.
+"""
+
+import csv
+
+import numpy as np
+
+# 8-bit popcount table for NumPy versions without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+
+def popcount_rows(bits):
+    """Number of set bits in each row of a uint64 matrix."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int64)
+    return _POPCOUNT[bits.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+class PlaylistSets:
+    """A collection of playlists as sorted ID arrays and bitsets."""
+
+    def __init__(self, labels, names, ids):
+        self.labels = list(labels)
+        # names[i] is the track with ID i, ids holds a sorted ID array per playlist
+        self.names = names
+        self.ids = ids
+        # One row of bits per playlist, padded to whole 64-bit words: the
+        # bit of track ID i is bit i % 64 of word i // 64
+        words = (len(self.names) + 63) // 64
+        self.bits = np.zeros((len(self.ids), words), np.uint64)
+        for row, playlist_ids in enumerate(self.ids):
+            np.bitwise_or.at(self.bits[row], playlist_ids >> 6,
+                             np.left_shift(np.uint64(1), (playlist_ids & 63).astype(np.uint64)))
+
+    @classmethod
+    def from_name_sets(cls, labels, name_sets):
+        """Build from one set of track names per playlist."""
+        # Integer ID of every distinct track name, in sorted name order
+        names = sorted(set().union(*name_sets))
+        index = {name: i for i, name in enumerate(names)}
+        ids = [np.sort(np.fromiter((index[name] for name in playlist), np.int64,
+                                   len(playlist)))
+               for playlist in name_sets]
+        return cls(labels, names, ids)
+
+    @classmethod
+    def from_track_ids(cls, labels, arrays):
+        """Build from one sorted Track ID array per playlist of a library.
+
+        The 'names' of the tracks are then their Track IDs.
+        """
+        track_ids = np.unique(np.concatenate(arrays)) if arrays else np.zeros(0, np.int64)
+        ids = [np.searchsorted(track_ids, playlist).astype(np.int64) for playlist in arrays]
+        return cls(labels, track_ids.tolist(), ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sizes(self):
+        """Number of tracks in each playlist."""
+        return np.array([len(ids) for ids in self.ids], np.int64)
+
+    def intersection_counts(self):
+        """Matrix of pairwise intersection sizes (diagonal: playlist sizes)."""
+        count = len(self)
+        counts = np.zeros((count, count), np.int64)
+        for row in range(count):
+            counts[row, row:] = popcount_rows(self.bits[row] & self.bits[row:])
+        # The matrix is symmetric, mirror the upper triangle
+        return np.triu(counts) + np.triu(counts, 1).T
+
+    def jaccard(self):
+        """Matrix of pairwise Jaccard similarities."""
+        counts = self.intersection_counts()
+        sizes = np.diag(counts)
+        unions = sizes[:, None] + sizes[None, :] - counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(unions > 0, counts / unions, 0.0)
+
+    def unique_counts(self):
+        """Number of tracks found in only one playlist, per playlist."""
+        if not self.names:
+            return np.zeros(len(self), np.int64)
+        occurrences = np.bincount(np.concatenate(self.ids), minlength=len(self.names))
+        return np.array([np.count_nonzero(occurrences[ids] == 1) for ids in self.ids],
+                        np.int64)
+
+    def unique(self, index):
+        """Names of the tracks found only in the given playlist."""
+        others = [ids for i, ids in enumerate(self.ids) if i != index]
+        rest = np.unique(np.concatenate(others)) if others else np.zeros(0, np.int64)
+        return self._names(np.setdiff1d(self.ids[index], rest, assume_unique=True))
+
+    def union(self, indices=None):
+        """Names of the tracks in any of the given playlists (default: all)."""
+        if indices is None:
+            indices = range(len(self))
+        ids = [self.ids[i] for i in indices]
+        return self._names(np.unique(np.concatenate(ids)) if ids else ids)
+
+    def difference(self, a, b):
+        """Names of the tracks in playlist a but not in playlist b."""
+        return self._names(np.setdiff1d(self.ids[a], self.ids[b], assume_unique=True))
+
+    def _names(self, ids):
+        return [self.names[i] for i in np.asarray(ids, np.int64).tolist()]
+
+    def write_csv(self, path):
+        """Write the Jaccard matrix with per-playlist sizes as CSV."""
+        jaccard = self.jaccard()
+        sizes = self.sizes()
+        unique = self.unique_counts()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['playlist', 'tracks', 'unique'] + self.labels)
+            for row, label in enumerate(self.labels):
+                writer.writerow([label, sizes[row], unique[row]]
+                                + [f"{value:.4f}" for value in jaccard[row]])
@@ -0,0 +1,79 @@
+"""
+playlistindex.py
+
+Playlist membership of a library export.
+
+The playlists of a full library export are held in CSR form: one sorted
+Track ID array per playlist, concatenated, with an offsets array. The inverse
+(Track ID -> playlists) is derived from it with one argsort when first
+needed, so membership questions never go back to the XML.
+"""
+
+import numpy as np
+
+
+class PlaylistIndex:
+    """Playlists of a library with sorted Track ID arrays and an inverted index."""
+
+    def __init__(self, ids, names, master, offsets, tracks):
+        self.ids = ids  # Playlist ID of each playlist
+        self.names = names  # list of playlist names
+        self.master = master  # True for the whole-library playlist
+        # Track IDs of playlist i are tracks[offsets[i]:offsets[i+1]], sorted
+        self.offsets = offsets
+        self.tracks = tracks
+        self._inverted = None
+
+    @classmethod
+    def from_playlists(cls, playlists):
+        """Build the index from playlist dicts as yielded by iter_playlists."""
+        ids, names, master, arrays = [], [], [], []
+        for playlist in playlists:
+            ids.append(playlist.get('Playlist ID', -1))
+            names.append(playlist.get('Name', ''))
+            master.append(bool(playlist.get('Master', False)))
+            items = playlist.get('Playlist Items', ())
+            arrays.append(np.unique(np.frombuffer(items, np.int32) if len(items)
+                                    else np.zeros(0, np.int32)))
+        offsets = np.zeros(len(arrays) + 1, np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        tracks = np.concatenate(arrays) if arrays else np.zeros(0, np.int32)
+        return cls(np.array(ids, np.int64), names, np.array(master, bool),
+                   offsets, tracks.astype(np.int32))
+
+    def __len__(self):
+        return len(self.names)
+
+    def track_ids(self, index):
+        """Sorted Track IDs of the playlist at position index."""
+        return self.tracks[self.offsets[index]:self.offsets[index + 1]]
+
+    def find(self, name_or_id):
+        """Position of a playlist given its name or Playlist ID."""
+        if name_or_id in self.names:
+            return self.names.index(name_or_id)
+        try:
+            matches = np.flatnonzero(self.ids == int(name_or_id))
+        except ValueError:
+            matches = []
+        if len(matches) == 0:
+            raise KeyError(f"No playlist named {name_or_id}")
+        return int(matches[0])
+
+    def selectable(self):
+        """Positions of all playlists except the whole-library one."""
+        return np.flatnonzero(~self.master).tolist()
+
+    def _inverse(self):
+        """Track IDs sorted, with the playlist position of each entry."""
+        if self._inverted is None:
+            owners = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+            order = np.argsort(self.tracks, kind='stable')
+            self._inverted = (np.asarray(self.tracks)[order], owners[order])
+        return self._inverted
+
+    def playlists_of(self, track_id):
+        """Positions of the playlists that contain a track, in playlist order."""
+        tracks, owners = self._inverse()
+        start, end = np.searchsorted(tracks, [track_id, track_id + 1])
+        return np.sort(owners[start:end]).tolist()
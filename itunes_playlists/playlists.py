@@ -1,112 +1,312 @@
-import plistlib
+import os
+import sys
 import numpy as np
-from matplotlib import pyplot as plt
 import argparse
+import asyncio
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
 
+from duplicates import (DUP_KEYS, changed_keys, groups_from_state, groups_to_state,
+                        update_duplicate_groups)
+from fuzzy import FUZZY_THRESHOLD
+from library import Library, intersect_smallest_first, merge_fuzzy_names
+from librarydiff import diff_tables, update_stats
+from overlap import PlaylistSets
+from plistreader import iter_tracks
+from report import ANALYZERS, write_report
+from resultcache import load_results, save_results
+from server import DEFAULT_ADDRESS, serve
+from stats import TrackStats, compute_stats, track_chunks
+from trackindex import DEFAULT_DB, build_index, query_help, run_query
+from tracktable import load_table
+from writers import FORMATS, open_output, record_writer
 
-def find_duplicates(file_name):
+
+def find_duplicates(file_name, use_cache=True, key='name', fuzzy=None,
+                    out_file='dups.txt', fmt=None):
     """Find duplicate tracks in given playlist."""
-    print(f"Finding duplicate tracks in {file_name}...")
-    # Read in a playlist
-    with open(file_name, 'rb') as fp:
-        plist = plistlib.load(fp)
-        tracks = plist['Tracks']
-    # Create a track name dictionary
-    track_names = {}
-    for track_id, track in tracks.items():
+    print(f"Finding duplicate tracks in {file_name}...", file=status_stream(out_file))
+    # Group tracks on the key and duration rounded down to the second
+    groups = Library(file_name, use_cache).duplicates(key, fuzzy)
+    write_duplicates(groups, out_file, fmt)
+
+
+def status_stream(out_file):
+    """Where to print progress: stderr when the results go to stdout."""
+    return sys.stderr if out_file == '-' else sys.stdout
+
+
+def write_duplicates(groups, out_file='dups.txt', fmt=None):
+    """Save duplicate groups to out_file ('-' for stdout)."""
+    fields = [('name', 'str'), ('duration', 'int'), ('count', 'int'), ('track_ids', 'ints')]
+    with record_writer(out_file, fields, "[{name}] {count}", fmt) as writer:
+        for group in groups:
+            writer.write({'name': ' - '.join(value or '' for value in group.key),
+                          'duration': group.duration,
+                          'count': len(group.track_ids),
+                          'track_ids': group.track_ids.tolist()})
+    out = status_stream(out_file)
+    if groups:
+        print(f"Found {len(groups)} duplicates. Track names saved to {out_file}", file=out)
+    else:
+        print("no duplicates found!", file=out)
+
+
+def playlist_track_names(file_name, use_cache=True):
+    """Return the set of track names in a playlist file."""
+    return Library(file_name, use_cache).track_names()
+
+
+def load_track_name_sets(file_names, use_cache=True, jobs=1):
+    """Load the track name set of each playlist, in parallel if jobs > 1.
+
+    Workers only send back the name sets, not the parsed tracks.
+    """
+    jobs = min(jobs or os.cpu_count(), len(file_names))
+    if jobs <= 1:
+        return [playlist_track_names(file_name, use_cache) for file_name in file_names]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(playlist_track_names, file_names,
+                             [use_cache] * len(file_names)))
+
+
+def find_common_tracks(file_names, use_cache=True, fuzzy=None, jobs=1, selection=None,
+                       out_file='common.txt', fmt=None):
+    """Find common tracks across multiple playlists.
+
+    Given a single library file, its own playlists (all of them, or those
+    in selection) are compared instead.
+    """
+    if len(file_names) == 1:
+        library = Library(file_names[0], use_cache)
         try:
-            name, duration = track['Name'], track['Total Time']
-            if name in track_names:
-                # if a name and duration match, increment the count
-                # round the track length to the nearest second
-                if duration//1000 == track_names[name][0]//1000:
-                    count = track_names[name][1]
-                    track_names[name] = (duration, count+1)
-            else:
-                # Add dictionary entry as tuple (duration, 1)
-                track_names[name] = (duration, 1)
-        except:
-            # ignore
-            pass
-    # Store duplicates as (name, count) tuples
-    dups = []
-    for name, info in track_names.items():
-        if info[1] > 1:  # check if count > 1
-            dups.append((name, info[1]))
-    # Save duplicates to a file
-    dups_len = len(dups)
-    if dups_len > 0:
-        print(f"Found {dups_len} duplicates. Track names saved to dup.txt")
+            common_tracks = library.common_in_playlists(selection, fuzzy)
+        except (KeyError, ValueError) as e:
+            print(e.args[0], file=status_stream(out_file))
+            return
     else:
-        print("no duplicates found!")
-    with open("dups.txt", "w") as f:
-        for track in dups:
-            f.write(f"[{track[0]}] {track[1]}")
-
-
-def find_common_tracks(file_names):
-    """Find common tracks across multiple playlists."""
-    track_names_sets = []
-    for file_name in file_names:
-        track_names = set()
-        # Read in playlist
-        with open(file_name, 'rb') as fp:
-            plist = plistlib.load(fp)
-            tracks = plist['Tracks']
-        # Iterate through the tracks
-        for track_id, track in tracks.items():
-            try:
-                track_names.add(track['Name'])
-            except:
-                pass
-        track_names_sets.append(track_names)
-    # Get the set of common tracks
-    common_tracks = set.intersection(*track_names_sets)
+        track_names_sets = load_track_name_sets(file_names, use_cache, jobs)
+        if fuzzy is not None:
+            # Match near-duplicate names across all playlists
+            track_names_sets = merge_fuzzy_names(track_names_sets, fuzzy)
+        # Get the set of common tracks
+        common_tracks = sorted(intersect_smallest_first(track_names_sets))
     len_common_tracks = len(common_tracks)
     if len_common_tracks > 0:
-        with open("common.txt", "w") as f:
+        with record_writer(out_file, [('name', 'str')], "{name}", fmt) as writer:
             for track in common_tracks:
-                f.write(f"{track} \n")
-        print(f"{len_common_tracks} found. Track names written to common.txt")
+                writer.write({'name': track})
+        print(f"{len_common_tracks} found. Track names written to {out_file}",
+              file=status_stream(out_file))
     else:
-        print("No common tracks")
+        print("No common tracks", file=status_stream(out_file))
+
+
+SET_OPS = ('unique', 'union', 'difference')
 
 
-def plot_stats(file_name):
-    """Gather ratings and track durations and plot."""
-    with open(file_name, 'rb') as f:
-        plist = plistlib.load(f)
-        tracks = plist['Tracks']
-    # Create lists of song ratings and track durations
-    ratings, durations = [], []
-    for track_id, track in tracks.items():
+def find_overlap(file_names, use_cache=True, fuzzy=None, jobs=1, out_file='overlap.csv',
+                 selection=None, set_op=None, sets_file='sets.txt', fmt=None):
+    """Compute how every pair of playlists overlaps and save it as CSV.
+
+    Given a single library file, its own playlists (all of them, or those
+    in selection) are compared instead. With set_op, the tracks of that set
+    operation (see write_set_op) are also written to sets_file.
+    """
+    out = status_stream(sets_file if set_op else out_file)
+    names = {}
+    if len(file_names) == 1:
+        library = Library(file_names[0], use_cache)
         try:
-            ratings.append(track['Album Rating'])
-            durations.append(track['Total Time'])
-        except:
-            pass
-    if ratings == [] or durations == []:
-        print(f"No valid Album Rating/Total Time data in {file_name}")
+            playlists = library.playlist_overlap(selection, fuzzy)
+        except KeyError as e:
+            print(e.args[0], file=out)
+            return
+        if fuzzy is None:
+            # The playlists hold Track IDs, write the tracks' names instead
+            names = dict(zip(library.table.track_id.tolist(), library.field('name')))
+    else:
+        track_names_sets = load_track_name_sets(file_names, use_cache, jobs)
+        if fuzzy is not None:
+            track_names_sets = merge_fuzzy_names(track_names_sets, fuzzy)
+        labels = [os.path.basename(file_name) for file_name in file_names]
+        playlists = PlaylistSets.from_name_sets(labels, track_names_sets)
+    playlists.write_csv(out_file)
+    print(f"{len(playlists.names)} distinct tracks in {len(playlists)} playlists.", file=out)
+    for label, size, unique in zip(playlists.labels, playlists.sizes(),
+                                   playlists.unique_counts()):
+        print(f"{label}: {size} tracks, {unique} only in this playlist", file=out)
+    print(f"Overlap matrix written to {out_file}", file=out)
+    if set_op:
+        count = write_set_op(playlists, set_op, sets_file, fmt, names)
+        print(f"{count} tracks of the {set_op} written to {sets_file}", file=out)
+
+
+def write_set_op(playlists, set_op, out_file='sets.txt', fmt=None, names=None):
+    """Write the tracks of a set operation over PlaylistSets to out_file.
+
+    set_op is 'unique' (the tracks found in only one playlist, per
+    playlist), 'union' (the tracks of any playlist) or 'difference' (for
+    every ordered pair of playlists, the tracks of the first one that are
+    not in the second). names optionally maps the tracks of playlists
+    to the names to write. Returns the number of records written.
+    """
+    if set_op == 'unique':
+        parts = ((label, playlists.unique(i)) for i, label in enumerate(playlists.labels))
+    elif set_op == 'union':
+        parts = [('union', playlists.union())]
+    else:
+        parts = ((f"{playlists.labels[a]} - {playlists.labels[b]}", playlists.difference(a, b))
+                 for a in range(len(playlists)) for b in range(len(playlists)) if a != b)
+    count = 0
+    with record_writer(out_file, [('set', 'str'), ('track', 'str')], "{set}\t{track}",
+                       fmt) as writer:
+        for label, tracks in parts:
+            for track in tracks:
+                writer.write({'set': label, 'track': str((names or {}).get(track) or track)})
+                count += 1
+    return count
+
+
+def plot_stats(file_name, use_cache=True, out_file=None, fmt=None, plot_file=None):
+    """Gather ratings and track durations, save and/or plot them.
+
+    Statistics are written to out_file ('-' for stdout) as JSON or CSV and
+    the plot is rendered to plot_file. With neither given the plot is shown.
+    """
+    if use_cache:
+        # Reuses the statistics of an earlier run (or of --diff)
+        stats = Library(file_name).stats()
+    else:
+        # Compute straight from the XML stream without building a table
+        stats = compute_stats(track_chunks(iter_tracks(file_name)))
+    out = status_stream(out_file)
+    if stats.paired == 0:
+        print(f"No valid Album Rating/Total Time data in {file_name}", file=out)
+        if not out_file:
+            return
+
+    if out_file:
+        if fmt is None:
+            fmt = 'csv' if out_file.endswith('.csv') else 'json'
+        with open_output(out_file) as f:
+            stats.write(f, fmt)
+        if out_file != '-':
+            print(f"Statistics written to {out_file}", file=out)
+    if plot_file:
+        stats.plot(plot_file)
+        print(f"Plot saved to {plot_file}", file=out)
+    elif not out_file:
+        # Show plot
+        stats.plot()
+
+
+def diff_libraries(old_file, new_file, use_cache=True, out_file='diff.txt'):
+    """Find added, removed and modified tracks between two exports.
+
+    Duplicate groups and statistics saved for the old export are brought up
+    to date from the changes alone and saved for the new one.
+    """
+    old, new = load_table(old_file, use_cache), load_table(new_file, use_cache)
+    diff = diff_tables(old, new)
+    print(f"{len(diff.added)} added, {len(diff.removed)} removed, "
+          f"{len(diff.modified_new)} modified tracks")
+    with open(out_file, "w") as f:
+        for mark, table, rows in (('+', new, diff.added), ('-', old, diff.removed),
+                                  ('~', new, diff.modified_new)):
+            for track in table.records(rows):
+                f.write(f"{mark} {track.track_id} {track.name}\n")
+    print(f"Changes written to {out_file}")
+    if not use_cache:
         return
 
-    # Scatter plot
-    x = np.array(durations, np.int32)
-    x = x/60000.0  # convert to minutes
-    y = np.array(ratings, np.int32)
+    results = load_results(old_file)
+    updated = {}
+    if 'dups' in results:
+        key = results['dups']['key']
+        changed = (changed_keys(old, np.concatenate([diff.removed, diff.modified_old]), key)
+                   | changed_keys(new, np.concatenate([diff.added, diff.modified_new]), key))
+        groups = update_duplicate_groups(groups_from_state(results['dups']['groups']),
+                                         new, changed, key)
+        updated['dups'] = {'key': key, 'groups': groups_to_state(groups)}
+    if 'stats' in results:
+        stats = update_stats(TrackStats.from_state(results['stats']), old, new, diff)
+        updated['stats'] = stats.to_state()
+    if updated:
+        save_results(new_file, **updated)
+        print(f"Updated cached {' and '.join(updated)} results for {new_file}")
 
-    fig, axs = plt.subplots(2)
-    fig.suptitle("Playlists statistics")
 
-    axs[0].plot(x, y, 'ro')
-    axs[0].axis([0, 1.05*np.max(x), -1, 110])
-    axs[0].set(xlabel='Track duration', ylabel='Track rating')
+def report_library(file_name, use_cache=True, analyzers=None, dup_key='name',
+                   out_file='report.json'):
+    """Run the health report analyzers over one pass of an export.
 
-    # Plot histogram
-    axs[1].hist(x, bins=20)
-    axs[1].set(xlabel='Track duration', ylabel='Count')
+    The report is written as JSON to out_file ('-' for stdout).
+    """
+    out = status_stream(out_file)
+    print(f"Analyzing {file_name}...", file=out)
+    try:
+        report = Library(file_name, use_cache).report(analyzers, dup_key)
+    except ValueError as e:
+        print(e, file=out)
+        return
+    if out_file == '-':
+        write_report(report, sys.stdout)
+    else:
+        with open(out_file, 'w', encoding='utf-8') as f:
+            write_report(report, f)
+    if 'duplicates' in report:
+        print(f"{report['duplicates']['groups']} duplicate groups", file=out)
+    if 'missing' in report:
+        print(', '.join(f"{values['count']} without {field}"
+                        for field, values in report['missing'].items()), file=out)
+    if 'outliers' in report and report['outliers']['tracks']:
+        print(f"{report['outliers']['too_short']} unusually short and "
+              f"{report['outliers']['too_long']} unusually long tracks", file=out)
+    print(f"Report on {report['tracks']} tracks written to {out_file}", file=out)
 
-    # Show plot
-    plt.show()
+
+def serve_libraries(address, root='.', preload=(), use_cache=True):
+    """Answer queries about warm libraries over HTTP until interrupted."""
+    try:
+        asyncio.run(serve(address, root, preload or (), use_cache))
+    except KeyboardInterrupt:
+        print("Stopped.")
+
+
+def index_library(file_name, db_path):
+    """Import an export into the SQLite track index."""
+    print(f"Indexing {file_name} into {db_path}...")
+    count = build_index(file_name, db_path)
+    print(f"{count} tracks indexed.")
+
+
+def query_library(db_path, query):
+    """Run a query against the SQLite track index and print the rows."""
+    try:
+        columns, rows = run_query(db_path, query[0], query[1:])
+    except ValueError as e:
+        print(e)
+        return
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+
+
+def report_peak_memory():
+    """Peak Python heap (traced) and process RSS as a short description.
+
+    Memory mapped track caches are in the RSS but not in the traced heap.
+    """
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    try:
+        # Not available on Windows
+        import resource
+    except ImportError:
+        return f"{peak:.1f} MB Python heap"
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return f"{peak:.1f} MB Python heap, {rss:.1f} MB max RSS"
 
 
 def main():
@@ -119,22 +319,102 @@ def main():
     group.add_argument('--common', nargs="*", dest='plFiles', required=False)
     group.add_argument('--stats', dest='plFile', required=False)
     group.add_argument('--dup', dest='plFileD', required=False)
+    group.add_argument('--overlap', nargs="+", dest='plFilesO', required=False)
+    group.add_argument('--diff', nargs=2, dest='diffFiles', metavar=('OLD', 'NEW'),
+                       required=False)
+    group.add_argument('--report', dest='reportFile', required=False,
+                       help="Health report of an export in one pass (JSON, see --analyzers)")
+    parser.add_argument('--analyzers', dest='analyzers',
+                        help=f"Comma separated --report analyzers (default: all of "
+                        f"{','.join(ANALYZERS)})")
+    parser.add_argument('--playlist', action='append', dest='playlists',
+                        help="With a single library file for --common/--overlap, "
+                        "compare this playlist (name or ID; repeatable)")
+    parser.add_argument('--overlap-out', dest='overlap_out', default='overlap.csv',
+                        help="CSV file for the --overlap matrix")
+    parser.add_argument('--set-op', dest='set_op', choices=SET_OPS,
+                        help="With --overlap, also write the tracks unique to each "
+                        "playlist, their union or their pairwise differences to --out")
+    group.add_argument('--index', dest='indexFile', required=False,
+                       help="Import the export into the SQLite track index (--db)")
+    group.add_argument('--query', nargs='+', dest='query', metavar='QUERY',
+                       help=f"Query the track index: {query_help()}")
+    group.add_argument('--serve', dest='serve', nargs='?', const=DEFAULT_ADDRESS,
+                       metavar='HOST:PORT',
+                       help=f"Serve JSON queries over HTTP (default {DEFAULT_ADDRESS})")
+    parser.add_argument('--root', dest='root', default='.',
+                        help="Directory of the libraries --serve may load")
+    parser.add_argument('--preload', action='append', dest='preload',
+                        help="Library to load before --serve starts (repeatable)")
+    parser.add_argument('--db', dest='db', default=DEFAULT_DB,
+                        help="SQLite track index used by --index and --query")
+    parser.add_argument('--out', dest='out',
+                        help="Result file of --dup/--common/--report/--set-op "
+                        "('-' for stdout)")
+    parser.add_argument('--format', dest='format', choices=FORMATS,
+                        help="Format of --out (default: from the file extension)")
+    parser.add_argument('--stats-out', dest='stats_out',
+                        help="Write --stats numbers to this file ('-' for stdout)")
+    parser.add_argument('--stats-format', dest='stats_format', choices=['json', 'csv'],
+                        help="Format of --stats-out (default: from the file extension)")
+    parser.add_argument('--plot-out', dest='plot_out',
+                        help="Render the --stats plot to this image file")
+    parser.add_argument('--dup-key', dest='dup_key', choices=list(DUP_KEYS),
+                        default='name', help="Fields that identify a duplicate")
+    parser.add_argument('--fuzzy', dest='fuzzy', type=float, nargs='?',
+                        const=FUZZY_THRESHOLD, default=None,
+                        help="Match near-duplicate names (optional similarity 0-1)")
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help="Playlists to load in parallel for --common/--overlap (0: one per CPU)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Parse the XML again instead of using the track cache")
+    parser.add_argument('--mem', dest='mem', action='store_true',
+                        help="Report the peak memory used by the command")
 
     # Parse args
     args = parser.parse_args()
+    if args.mem:
+        tracemalloc.start()
 
     if args.plFiles:
         # Find common tracks
-        find_common_tracks(args.plFiles)
+        find_common_tracks(args.plFiles, args.use_cache, args.fuzzy, args.jobs,
+                           args.playlists, args.out or 'common.txt', args.format)
     elif args.plFile:
         # Plot stats
-        plot_stats(args.plFile)
+        plot_stats(args.plFile, args.use_cache, args.stats_out, args.stats_format,
+                   args.plot_out)
     elif args.plFileD:
         # Find duplicate  tracks
-        find_duplicates(args.plFileD)
+        find_duplicates(args.plFileD, args.use_cache, args.dup_key, args.fuzzy,
+                        args.out or 'dups.txt', args.format)
+    elif args.plFilesO:
+        # Pairwise overlap of playlists
+        find_overlap(args.plFilesO, args.use_cache, args.fuzzy, args.jobs, args.overlap_out,
+                     args.playlists, args.set_op, args.out or 'sets.txt', args.format)
+    elif args.diffFiles:
+        # Changes between two exports
+        diff_libraries(*args.diffFiles, use_cache=args.use_cache)
+    elif args.reportFile:
+        # All analyses in one pass
+        report_library(args.reportFile, args.use_cache,
+                       args.analyzers.split(',') if args.analyzers else None,
+                       args.dup_key, args.out or 'report.json')
+    elif args.serve:
+        # Long-running query service
+        serve_libraries(args.serve, args.root, args.preload, args.use_cache)
+    elif args.indexFile:
+        # Build the SQLite index
+        index_library(args.indexFile, args.db)
+    elif args.query:
+        # Query the SQLite index
+        query_library(args.db, args.query)
     else:
         print("These are not the tracks you are looking for.")
 
+    if args.mem:
+        print(f"Peak memory: {report_peak_memory()}", file=sys.stderr)
+
     # find_duplicates('test_files/mymusic.xml')
     # find_common_tracks(['test_files/pl1.xml', 'test_files/pl2.xml'])
     # plot_stats('test_files/mymusic.xml')
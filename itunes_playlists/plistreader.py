@@ -0,0 +1,144 @@
+"""
+plistreader.py
+
+Streaming reader for iTunes library/playlist exports (.xml plist files).
+
+plistlib.load builds the whole document in memory before returning, which
+for large libraries costs many times the file size. The functions here walk
+the file with ElementTree.iterparse and hand back one track at a time,
+discarding each element as soon as it has been converted. Playlist items are
+reduced to an array of Track IDs while they are read.
+
+Dict keys and the values of fields repeated across many tracks (artist,
+album, genre...) are interned, so tracks that are kept share one copy of
+each of these strings.
+"""
+
+import array
+import base64
+import datetime
+import sys
+from xml.etree import ElementTree
+
+# Keys whose string values repeat from track to track
+INTERNED_KEYS = frozenset(['Artist', 'Album Artist', 'Album', 'Composer', 'Genre',
+                           'Kind', 'Grouping', 'Sort Artist', 'Sort Album'])
+
+
+def plist_value(elem):
+    """Convert a plist value element into the matching Python object."""
+    tag = elem.tag
+    if tag == 'string':
+        return elem.text or ''
+    if tag == 'integer':
+        return int(elem.text)
+    if tag == 'real':
+        return float(elem.text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag == 'date':
+        return datetime.datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ")
+    if tag == 'data':
+        return base64.b64decode(elem.text or '')
+    if tag == 'array':
+        return [plist_value(child) for child in elem]
+    if tag == 'dict':
+        return plist_dict(elem)
+    raise ValueError(f"Unknown plist element <{tag}>")
+
+
+def plist_dict(elem):
+    """Convert a plist <dict> element (key/value children) into a dict."""
+    result = {}
+    children = iter(elem)
+    for key in children:
+        key = sys.intern(key.text)
+        value = plist_value(next(children))
+        if key in INTERNED_KEYS and isinstance(value, str):
+            value = sys.intern(value)
+        result[key] = value
+    return result
+
+
+def iter_library(file_name, sections=('Tracks', 'Playlists')):
+    """Yield (section, item) for the tracks and/or playlists of an export.
+
+    Tracks are yielded as ('Tracks', track dict). Playlists are yielded as
+    ('Playlists', playlist dict) where 'Playlist Items' is an array('i') of
+    Track IDs rather than a list of dicts. Reading stops as soon as all
+    requested sections have been seen. file_name may also be a binary file
+    object.
+    """
+    # Depth of the elements we care about:
+    # <plist> 1, top level <dict> 2, Tracks <dict>/Playlists <array> 3,
+    # track/playlist <dict> 4, Playlist Items <array> 5, item <dict> 6
+    depth = 0
+    last_key = None
+    section_elem = None
+    remaining = set(sections)
+    # Playlist being read: its last key, items array element and Track IDs
+    playlist_key = None
+    items_elem = None
+    items = None
+    for event, elem in ElementTree.iterparse(file_name, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 3 and last_key in remaining and elem.tag in ('dict', 'array'):
+                section_elem = elem
+            elif depth == 4 and section_elem is not None and last_key == 'Playlists':
+                items = array.array('i')
+                playlist_key = None
+            elif (depth == 5 and items is not None and elem.tag == 'array'
+                    and playlist_key == 'Playlist Items'):
+                items_elem = elem
+            continue
+        depth -= 1
+        if depth == 2 and elem.tag == 'key':
+            # Keys of the top level dict name the section that follows
+            last_key = elem.text
+        elif depth == 2 and elem is section_elem:
+            section_elem.clear()
+            section_elem = None
+            remaining.discard(last_key)
+            if not remaining:
+                return
+        elif section_elem is None:
+            continue
+        elif depth == 3 and elem.tag == 'dict':
+            if last_key == 'Tracks':
+                yield last_key, plist_dict(elem)
+            else:
+                playlist = plist_dict(elem)
+                playlist['Playlist Items'] = items
+                items = None
+                yield last_key, playlist
+            # Drop the parsed item so memory stays flat
+            section_elem.clear()
+        elif depth == 4 and items is not None and elem.tag == 'key':
+            playlist_key = elem.text
+        elif depth == 4 and elem is items_elem:
+            items_elem = None
+        elif depth == 5 and items_elem is not None and elem.tag == 'dict':
+            # Keep only the Track ID of each playlist item
+            items.append(plist_dict(elem)['Track ID'])
+            items_elem.clear()
+
+
+def iter_tracks(file_name):
+    """Yield the track dicts of the 'Tracks' section one at a time.
+
+    file_name may also be a binary file object.
+    """
+    for _, track in iter_library(file_name, ('Tracks',)):
+        yield track
+
+
+def iter_playlists(file_name):
+    """Yield the playlist dicts of the 'Playlists' section one at a time.
+
+    'Playlist Items' of each playlist is an array('i') of Track IDs.
+    """
+    for _, playlist in iter_library(file_name, ('Playlists',)):
+        yield playlist
@@ -0,0 +1,224 @@
+"""
+report.py
+
+Library health report: several analyses over one pass of the tracks.
+
+Each analyzer sees the same chunks of the track table (numeric columns and
+interned string codes, CHUNK_SIZE tracks at a time) through update(), and
+returns JSON-serializable data from result(). The export is parsed once,
+however many analyzers run, and analyzers only keep small accumulators
+between chunks.
+
+An analyzer is any class taking the TrackTable in its constructor with
+update(chunk) and result() methods; register it in ANALYZERS to make it
+available to --report.
+"""
+
+import json
+
+import numpy as np
+
+from duplicates import DUP_KEYS, DURATION_BUCKET, group_boundaries
+from stats import CHUNK_SIZE, MAX_SECONDS, TrackStats
+from tracktable import MISSING
+
+# Tracks outside OUTLIER_IQR interquartile ranges beyond the quartiles
+OUTLIER_IQR = 3.0
+# Number of entries listed by the top-N sections of the report
+TOP = 20
+
+
+def table_columns(table, chunk_size=CHUNK_SIZE):
+    """Yield dicts of column slices of a TrackTable, chunk_size rows each.
+
+    Numeric fields are arrays of values and string fields arrays of codes,
+    MISSING where a track has no value.
+    """
+    fields = ('track_id', 'total_time', 'album_rating')
+    for start in range(0, len(table), chunk_size):
+        chunk = {field: np.asarray(getattr(table, field)[start:start + chunk_size])
+                 for field in fields}
+        chunk.update({field: np.asarray(column.codes[start:start + chunk_size])
+                      for field, column in table.strings.items()})
+        yield chunk
+
+
+class DuplicatesAnalyzer:
+    """Groups of tracks sharing a key and duration bucket (see duplicates.py)."""
+
+    def __init__(self, table, key='name', bucket=DURATION_BUCKET):
+        self.table = table
+        self.fields = DUP_KEYS[key]
+        self.bucket = bucket
+        self.parts = []
+
+    def update(self, chunk):
+        # Only the key codes and buckets of matchable tracks are kept
+        valid = (chunk['name'] != MISSING) & (chunk['total_time'] != MISSING)
+        self.parts.append([chunk[field][valid] for field in self.fields]
+                          + [chunk['total_time'][valid] // self.bucket,
+                             chunk['track_id'][valid]])
+
+    def result(self):
+        if self.parts:
+            columns = [np.concatenate(part) for part in zip(*self.parts)]
+        else:
+            columns = [np.zeros(0, np.int64)] * (len(self.fields) + 2)
+        order = np.lexsort(columns[-2::-1])
+        columns = [column[order] for column in columns]
+        starts, sizes = group_boundaries(columns[:-1])
+        dup = sizes > 1
+        starts, sizes = starts[dup], sizes[dup]
+        largest = np.argsort(-sizes, kind='stable')[:TOP]
+        top = []
+        for start, size in zip(starts[largest].tolist(), sizes[largest].tolist()):
+            codes = [int(columns[i][start]) for i in range(len(self.fields))]
+            key = [None if code == MISSING else self.table.strings[field].values[code]
+                   for field, code in zip(self.fields, codes)]
+            top.append({'key': key,
+                        'duration': int(columns[-2][start]) * self.bucket // 1000,
+                        'track_ids': columns[-1][start:start + size].tolist()})
+        return {'groups': len(sizes), 'tracks': int(sizes.sum()),
+                'redundant_copies': int((sizes - 1).sum()), 'largest': top}
+
+
+class MissingFieldsAnalyzer:
+    """Number of tracks without each field, with a few of their Track IDs."""
+
+    FIELDS = {'total_time': 'Total Time', 'album_rating': 'Album Rating',
+              'name': 'Name', 'artist': 'Artist', 'album': 'Album'}
+
+    def __init__(self, table):
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        self.examples = {field: [] for field in self.FIELDS}
+
+    def update(self, chunk):
+        for field in self.FIELDS:
+            missing = chunk[field] == MISSING
+            self.counts[field] += int(np.count_nonzero(missing))
+            examples = self.examples[field]
+            if len(examples) < TOP:
+                examples += chunk['track_id'][missing][:TOP - len(examples)].tolist()
+
+    def result(self):
+        return {key: {'count': self.counts[field], 'track_ids': self.examples[field]}
+                for field, key in self.FIELDS.items()}
+
+
+class RatingsAnalyzer:
+    """Album Rating distribution, and durations per rating (see stats.py)."""
+
+    def __init__(self, table):
+        self.stats = TrackStats()
+
+    def update(self, chunk):
+        self.stats.update(chunk['total_time'], chunk['album_rating'])
+
+    def result(self):
+        data = self.stats.to_dict()
+        return {'rated': int(self.stats.ratings.sum()),
+                'unrated': self.stats.missing_rating,
+                'histogram': data['rating_histogram'],
+                'duration_by_rating': data['duration_by_rating']}
+
+
+class DurationOutliersAnalyzer:
+    """Tracks far outside the interquartile range of durations.
+
+    The fences come from a per-second duration histogram. Only the TOP
+    shortest and longest tracks seen so far are kept, and listed if they
+    fall outside the fences.
+    """
+
+    def __init__(self, table):
+        self.seconds = np.zeros(MAX_SECONDS + 1, np.int64)
+        self.shortest = np.zeros((0, 2), np.int64)
+        self.longest = np.zeros((0, 2), np.int64)
+
+    def update(self, chunk):
+        has_duration = chunk['total_time'] != MISSING
+        durations = chunk['total_time'][has_duration]
+        self.seconds += np.bincount(np.clip(durations // 1000, 0, MAX_SECONDS),
+                                    minlength=MAX_SECONDS + 1)
+        pairs = np.column_stack([durations, chunk['track_id'][has_duration]])
+        self.shortest = self._extreme(np.concatenate([self.shortest, pairs]), 1)
+        self.longest = self._extreme(np.concatenate([self.longest, pairs]), -1)
+
+    @staticmethod
+    def _extreme(pairs, sign):
+        order = np.argsort(sign * pairs[:, 0], kind='stable')[:TOP]
+        return pairs[order]
+
+    def result(self):
+        total = int(self.seconds.sum())
+        if total == 0:
+            return {'tracks': 0}
+        cumulative = np.cumsum(self.seconds)
+        q1, q3 = np.searchsorted(cumulative, [0.25 * total, 0.75 * total]).tolist()
+        low = max(q1 - OUTLIER_IQR * (q3 - q1), 0)
+        high = q3 + OUTLIER_IQR * (q3 - q1)
+        seconds = np.arange(MAX_SECONDS + 1)
+        return {
+            'tracks': total,
+            'quartiles_seconds': [q1, q3],
+            'fences_seconds': [low, high],
+            'too_short': int(self.seconds[seconds < low].sum()),
+            'too_long': int(self.seconds[seconds > high].sum()),
+            'shortest': [{'track_id': int(track_id), 'seconds': int(duration) // 1000}
+                         for duration, track_id in self.shortest if duration // 1000 < low],
+            'longest': [{'track_id': int(track_id), 'seconds': int(duration) // 1000}
+                        for duration, track_id in self.longest if duration // 1000 > high],
+        }
+
+
+class ArtistsAnalyzer:
+    """Number of tracks per artist."""
+
+    def __init__(self, table):
+        self.artists = table.artist
+        self.counts = np.zeros(len(self.artists.offsets) - 1, np.int64)
+
+    def update(self, chunk):
+        codes = chunk['artist']
+        self.counts += np.bincount(codes[codes != MISSING], minlength=len(self.counts))
+
+    def result(self):
+        top = np.argsort(-self.counts, kind='stable')[:TOP]
+        values = self.artists.values
+        return {'artists': int(np.count_nonzero(self.counts)),
+                'top': {values[code]: int(self.counts[code])
+                        for code in top.tolist() if self.counts[code]}}
+
+
+ANALYZERS = {
+    'duplicates': DuplicatesAnalyzer,
+    'missing': MissingFieldsAnalyzer,
+    'ratings': RatingsAnalyzer,
+    'outliers': DurationOutliersAnalyzer,
+    'artists': ArtistsAnalyzer,
+}
+
+
+def run_report(table, analyzers=None, dup_key='name'):
+    """Run analyzers (names, default: all) over one pass of a table.
+
+    Returns {analyzer name: result}.
+    """
+    names = list(analyzers or ANALYZERS)
+    unknown = [name for name in names if name not in ANALYZERS]
+    if unknown:
+        raise ValueError(f"Unknown analyzer {', '.join(unknown)}, expected one of: "
+                         f"{', '.join(ANALYZERS)}")
+    running = {name: ANALYZERS[name](table, dup_key) if name == 'duplicates'
+               else ANALYZERS[name](table) for name in names}
+    for chunk in table_columns(table):
+        for analyzer in running.values():
+            analyzer.update(chunk)
+    return {'tracks': len(table),
+            **{name: analyzer.result() for name, analyzer in running.items()}}
+
+
+def write_report(report, f):
+    """Write a report to an open text file as JSON."""
+    json.dump(report, f, indent=2, ensure_ascii=False)
+    f.write('\n')
@@ -0,0 +1,55 @@
+"""
+resultcache.py
+
+Results of earlier runs (duplicate groups, statistics) saved next to an
+export, so they can be updated from a diff instead of being recomputed.
+
+Like the track cache, results are only valid while the export's size and
+mtime are unchanged.
+"""
+
+import json
+import os
+import sys
+
+RESULTS_SUFFIX = '.results.json'
+
+
+def results_path_for(file_name):
+    """Path of the results file kept next to an export."""
+    return file_name + RESULTS_SUFFIX
+
+
+def _source(file_name):
+    st = os.stat(file_name)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def load_results(file_name):
+    """Return the saved results of an export, {} if none are valid."""
+    path = results_path_for(file_name)
+    try:
+        with open(path) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if results.get('source') != _source(file_name):
+        return {}
+    return results.get('results', {})
+
+
+def save_results(file_name, **sections):
+    """Save result sections (e.g. dups=..., stats=...) for an export.
+
+    Sections saved earlier for the same version of the export are kept.
+    """
+    results = load_results(file_name)
+    results.update(sections)
+    path = results_path_for(file_name)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': _source(file_name), 'results': results}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save results to {path}: {e}", file=sys.stderr)
@@ -0,0 +1,304 @@
+"""
+server.py
+
+Local HTTP service answering queries about warm, in-memory libraries.
+
+Loaded libraries (see library.py) are kept in an LRU cache keyed by path,
+each tagged with the size and mtime of the export it was loaded from, so
+repeated questions about the same export are answered from memory. A
+background task checks the cached exports every few
+seconds and, when one has changed, loads and warms the new version before
+swapping it in; requests keep getting answers from the old version in the
+meantime. Loading and computing run in worker threads, so a slow library
+never blocks the event loop.
+
+Only the standard library is used (asyncio streams and a minimal HTTP/1.1
+request parser). Library paths are resolved under a root directory and
+requests for files outside of it are refused.
+
+    GET /duplicates?library=PATH[&key=name+artist][&fuzzy=0.8]
+    GET /stats?library=PATH
+    GET /common?library=PATH&library=PATH...   (one library: its playlists,
+                                                 optionally &playlist=NAME...)
+    GET /report?library=PATH[&analyzers=missing,artists]
+    GET /playlists?library=PATH&track=TRACK_ID
+    GET /libraries
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+from duplicates import DUP_KEYS
+from library import Library
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+# Number of libraries kept in memory
+CACHE_SIZE = 8
+# Seconds between checks of the cached exports for changes
+RELOAD_INTERVAL = 5.0
+MAX_REQUEST_LINE = 8192
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """A request that can't be answered; carries the HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LibraryCache:
+    """LRU cache of warm Library objects keyed by path."""
+
+    def __init__(self, root='.', size=CACHE_SIZE, use_cache=True):
+        self.root = os.path.realpath(root)
+        self.size = size
+        self.use_cache = use_cache
+        self.libraries = OrderedDict()  # path -> Library
+        self.locks = {}  # path -> asyncio.Lock serializing work on a library
+        self.reloading = set()
+
+    def resolve(self, path):
+        """Absolute path of a library file, which must be under root."""
+        full = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise RequestError(403, f"{path} is outside of the served directory")
+        if not os.path.isfile(full):
+            raise RequestError(404, f"No library at {path}")
+        return full
+
+    def _load(self, path):
+        library = Library(path, self.use_cache)
+        # Warm the library: read the table and the common results
+        library.table
+        library.duplicates()
+        library.stats()
+        return library
+
+    async def get(self, path):
+        """The Library of a path, loading it if it isn't cached yet."""
+        path = self.resolve(path)
+        library = self.libraries.get(path)
+        if library is None:
+            async with self.lock(path):
+                library = self.libraries.get(path)
+                if library is None:
+                    library = await asyncio.get_running_loop().run_in_executor(
+                        None, self._load, path)
+                    self._put(path, library)
+        if path in self.libraries:
+            self.libraries.move_to_end(path)
+        return library
+
+    def lock(self, path):
+        return self.locks.setdefault(path, asyncio.Lock())
+
+    async def run(self, library, func, *args):
+        """Run func(*args) in a worker thread, one at a time per library."""
+        async with self.lock(library.file_name):
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _put(self, path, library):
+        self.libraries[path] = library
+        self.libraries.move_to_end(path)
+        while len(self.libraries) > self.size:
+            evicted, _ = self.libraries.popitem(last=False)
+            self.locks.pop(evicted, None)
+
+    async def watch(self, interval=RELOAD_INTERVAL):
+        """Reload changed exports in the background, forever."""
+        while True:
+            await asyncio.sleep(interval)
+            for path, library in list(self.libraries.items()):
+                if library.is_stale() and path not in self.reloading and \
+                        os.path.isfile(path):
+                    self.reloading.add(path)
+                    asyncio.create_task(self._reload(path))
+
+    async def _reload(self, path):
+        try:
+            library = await asyncio.get_running_loop().run_in_executor(
+                None, self._load, path)
+            # Swap in the new version unless it was evicted meanwhile
+            if path in self.libraries:
+                self.libraries[path] = library
+            print(f"Reloaded {path}")
+        except Exception as e:
+            print(f"Could not reload {path}: {e}")
+        finally:
+            self.reloading.discard(path)
+
+    def describe(self):
+        """Cached libraries, most recently used last."""
+        return [{'path': path, 'size': library.source[0],
+                 'mtime_ns': library.source[1], 'stale': library.is_stale()}
+                for path, library in self.libraries.items()]
+
+
+def _one(params, name, default=None):
+    values = params.get(name)
+    return values[-1] if values else default
+
+
+def _libraries(params):
+    paths = params.get('library')
+    if not paths:
+        raise RequestError(400, "Missing library parameter")
+    return paths
+
+
+def _fuzzy(params):
+    value = _one(params, 'fuzzy')
+    try:
+        return None if value is None else float(value)
+    except ValueError:
+        raise RequestError(400, f"Invalid fuzzy threshold {value}")
+
+
+def _dup_key(params):
+    key = _one(params, 'key', 'name')
+    if key not in DUP_KEYS:
+        raise RequestError(400, f"Unknown key {key}, expected one of: {', '.join(DUP_KEYS)}")
+    return key
+
+
+async def duplicates(cache, params):
+    library = await cache.get(_libraries(params)[0])
+    key = _dup_key(params)
+    groups = await cache.run(library, library.duplicates, key, _fuzzy(params))
+    return {'library': library.file_name, 'key': key, 'groups': [
+        {'key': list(group.key), 'duration': group.duration,
+         'track_ids': group.track_ids.tolist()} for group in groups]}
+
+
+async def stats(cache, params):
+    library = await cache.get(_libraries(params)[0])
+    result = await cache.run(library, library.stats)
+    return {'library': library.file_name, **result.to_dict()}
+
+
+async def common(cache, params):
+    libraries = [await cache.get(path) for path in _libraries(params)]
+    fuzzy = _fuzzy(params)
+    if len(libraries) == 1:
+        try:
+            names = await cache.run(libraries[0], libraries[0].common_in_playlists,
+                                    params.get('playlist'), fuzzy)
+        except KeyError as e:
+            raise RequestError(404, e.args[0])
+        except ValueError as e:
+            raise RequestError(400, str(e))
+    else:
+        # Warm every library's name set under its own lock first
+        for library in libraries:
+            await cache.run(library, library.track_names)
+        names = await cache.run(libraries[0], lambda: libraries[0].common_with(
+            *libraries[1:], fuzzy=fuzzy))
+    return {'libraries': [library.file_name for library in libraries], 'tracks': names}
+
+
+async def report(cache, params):
+    library = await cache.get(_libraries(params)[0])
+    analyzers = _one(params, 'analyzers')
+    try:
+        result = await cache.run(library, library.report,
+                                 analyzers.split(',') if analyzers else None,
+                                 _dup_key(params))
+    except ValueError as e:
+        raise RequestError(400, str(e))
+    return {'library': library.file_name, **result}
+
+
+async def playlists(cache, params):
+    library = await cache.get(_libraries(params)[0])
+    value = _one(params, 'track')
+    try:
+        track_id = int(value)
+    except (TypeError, ValueError):
+        raise RequestError(400, f"Invalid or missing track ID {value}")
+    names = await cache.run(library, library.playlists_of, track_id)
+    return {'library': library.file_name, 'track': track_id, 'playlists': names}
+
+
+async def libraries(cache, params):
+    return {'libraries': cache.describe()}
+
+
+ROUTES = {
+    '/duplicates': duplicates,
+    '/stats': stats,
+    '/common': common,
+    '/report': report,
+    '/playlists': playlists,
+    '/libraries': libraries,
+}
+
+
+async def _respond(writer, status, body):
+    data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                 "Content-Type: application/json; charset=utf-8\r\n"
+                 f"Content-Length: {len(data)}\r\n"
+                 "Connection: keep-alive\r\n\r\n".encode('ascii') + data)
+    await writer.drain()
+
+
+async def handle(cache, reader, writer):
+    """Serve the requests of one (keep-alive) connection."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line or len(request_line) > MAX_REQUEST_LINE:
+                break
+            # Skip the headers, requests have no body
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            start = time.perf_counter()
+            try:
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                if method != 'GET':
+                    raise RequestError(405, "Only GET is supported")
+                url = urlsplit(target)
+                if url.path not in ROUTES:
+                    raise RequestError(404, f"Unknown endpoint {url.path}, expected one of: "
+                                       f"{', '.join(ROUTES)}")
+                status, body = 200, await ROUTES[url.path](cache, parse_qs(url.query))
+            except RequestError as e:
+                status, body = e.status, {'error': str(e)}
+            except ValueError:
+                status, body = 400, {'error': "Malformed request"}
+            except Exception as e:
+                status, body = 500, {'error': f"{type(e).__name__}: {e}"}
+            await _respond(writer, status, body)
+            print(f"{request_line.decode('latin-1').strip()} {status} "
+                  f"{1000 * (time.perf_counter() - start):.1f} ms")
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(address=DEFAULT_ADDRESS, root='.', preload=(), use_cache=True,
+                cache_size=CACHE_SIZE, reload_interval=RELOAD_INTERVAL):
+    """Run the service until cancelled."""
+    host, _, port = address.rpartition(':')
+    cache = LibraryCache(root, cache_size, use_cache)
+    for path in preload:
+        await cache.get(path)
+        print(f"Loaded {path}")
+    server = await asyncio.start_server(lambda r, w: handle(cache, r, w),
+                                        host or DEFAULT_ADDRESS.split(':')[0], int(port))
+    watcher = asyncio.create_task(cache.watch(reload_interval))
+    print(f"Serving {cache.root} on http://{host}:{port}/ ({', '.join(ROUTES)})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
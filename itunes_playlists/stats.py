@@ -0,0 +1,235 @@
+"""
+stats.py
+
+Track duration and rating statistics computed over chunks of tracks.
+
+TrackStats only keeps fixed-size histograms and per-rating sums, so memory
+does not depend on the number of tracks: chunks can come from the memory
+mapped track table or straight from the XML stream. Quantiles are read off a
+one-second duration histogram. Plots are only drawn when asked for, on the
+non-interactive Agg backend when written to a file.
+"""
+
+import csv
+import itertools
+import json
+
+import numpy as np
+
+from tracktable import MISSING
+
+CHUNK_SIZE = 65536
+
+# Durations are binned per second up to MAX_SECONDS, longer tracks share
+# the last bin
+MAX_SECONDS = 2 * 60 * 60
+# Album Rating goes from 0 to 100
+MAX_RATING = 100
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def table_chunks(table, chunk_size=CHUNK_SIZE):
+    """Yield (durations, ratings) slices of a TrackTable."""
+    for start in range(0, len(table), chunk_size):
+        yield (np.asarray(table.total_time[start:start + chunk_size]),
+               np.asarray(table.album_rating[start:start + chunk_size]))
+
+
+def track_chunks(tracks, chunk_size=CHUNK_SIZE):
+    """Yield (durations, ratings) arrays from an iterable of track dicts."""
+    tracks = iter(tracks)
+    while True:
+        chunk = list(itertools.islice(tracks, chunk_size))
+        if not chunk:
+            return
+        yield (np.array([track.get('Total Time', MISSING) for track in chunk], np.int64),
+               np.array([track.get('Album Rating', MISSING) for track in chunk], np.int64))
+
+
+class TrackStats:
+    """Incremental duration/rating statistics."""
+
+    def __init__(self):
+        self.tracks = 0
+        self.missing_duration = 0
+        self.missing_rating = 0
+        # Per-second duration histogram of all tracks with a duration
+        self.seconds = np.zeros(MAX_SECONDS + 1, np.int64)
+        # Histogram of ratings of all rated tracks
+        self.ratings = np.zeros(MAX_RATING + 1, np.int64)
+        # Rating x duration minute counts of tracks that have both
+        self.joint = np.zeros((MAX_RATING + 1, MAX_SECONDS // 60 + 1), np.int64)
+        # Per-rating duration sums for the mean/std (in seconds)
+        self.rating_sum = np.zeros(MAX_RATING + 1)
+        self.rating_sum_sq = np.zeros(MAX_RATING + 1)
+
+    def update(self, durations, ratings, sign=1):
+        """Add a chunk of durations (ms) and ratings; MISSING marks no value.
+
+        With sign=-1 the tracks are taken out again instead, which lets
+        cached statistics follow changes to a library.
+        """
+        durations = np.asarray(durations, np.int64)
+        ratings = np.asarray(ratings, np.int64)
+        self.tracks += sign * len(durations)
+        has_duration = durations != MISSING
+        has_rating = ratings != MISSING
+        self.missing_duration += sign * int(np.count_nonzero(~has_duration))
+        self.missing_rating += sign * int(np.count_nonzero(~has_rating))
+
+        seconds = np.clip(durations // 1000, 0, MAX_SECONDS)
+        ratings = np.clip(ratings, 0, MAX_RATING)
+        self.seconds += sign * np.bincount(seconds[has_duration], minlength=MAX_SECONDS + 1)
+        self.ratings += sign * np.bincount(ratings[has_rating], minlength=MAX_RATING + 1)
+
+        both = has_duration & has_rating
+        seconds, ratings = seconds[both], ratings[both]
+        np.add.at(self.joint, (ratings, seconds // 60), sign)
+        self.rating_sum += sign * np.bincount(ratings, seconds, minlength=MAX_RATING + 1)
+        self.rating_sum_sq += sign * np.bincount(ratings, seconds.astype(float) ** 2,
+                                                 minlength=MAX_RATING + 1)
+
+    def to_state(self):
+        """The accumulated arrays as JSON-serializable data, see from_state."""
+        joint = np.nonzero(self.joint)
+        return {
+            'tracks': self.tracks,
+            'missing_duration': self.missing_duration,
+            'missing_rating': self.missing_rating,
+            # Store the mostly empty histograms sparsely
+            'seconds': [np.flatnonzero(self.seconds).tolist(),
+                        self.seconds[self.seconds != 0].tolist()],
+            'ratings': self.ratings.tolist(),
+            'joint': [joint[0].tolist(), joint[1].tolist(), self.joint[joint].tolist()],
+            'rating_sum': self.rating_sum.tolist(),
+            'rating_sum_sq': self.rating_sum_sq.tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild statistics saved with to_state."""
+        stats = cls()
+        stats.tracks = state['tracks']
+        stats.missing_duration = state['missing_duration']
+        stats.missing_rating = state['missing_rating']
+        seconds, counts = state['seconds']
+        stats.seconds[seconds] = counts
+        stats.ratings[:] = state['ratings']
+        ratings, minutes, counts = state['joint']
+        stats.joint[ratings, minutes] = counts
+        stats.rating_sum[:] = state['rating_sum']
+        stats.rating_sum_sq[:] = state['rating_sum_sq']
+        return stats
+
+    @property
+    def paired(self):
+        """Number of tracks with both a duration and a rating."""
+        return int(self.joint.sum())
+
+    def quantiles(self, qs=QUANTILES):
+        """Duration quantiles in seconds, read off the histogram."""
+        total = self.seconds.sum()
+        if total == 0:
+            return {q: None for q in qs}
+        cumulative = np.cumsum(self.seconds)
+        return {q: int(np.searchsorted(cumulative, q * total)) for q in qs}
+
+    def minute_histogram(self):
+        """Duration histogram with one bin per minute."""
+        minutes = np.zeros(MAX_SECONDS // 60 + 1, np.int64)
+        np.add.at(minutes, np.arange(MAX_SECONDS + 1) // 60, self.seconds)
+        # Drop the empty tail
+        used = np.flatnonzero(minutes)
+        return minutes[:used[-1] + 1] if len(used) else minutes[:0]
+
+    def by_rating(self):
+        """Per-rating count, mean and standard deviation of duration (s)."""
+        counts = self.joint.sum(axis=1)
+        result = {}
+        for rating in np.flatnonzero(counts).tolist():
+            count = counts[rating]
+            mean = self.rating_sum[rating] / count
+            variance = max(self.rating_sum_sq[rating] / count - mean * mean, 0.0)
+            result[rating] = {'count': int(count), 'mean_seconds': round(mean, 1),
+                              'std_seconds': round(variance ** 0.5, 1)}
+        return result
+
+    def to_dict(self):
+        """All statistics as JSON-serializable data."""
+        return {
+            'tracks': self.tracks,
+            'missing_total_time': self.missing_duration,
+            'missing_album_rating': self.missing_rating,
+            'rated_with_duration': self.paired,
+            'duration_quantiles_seconds': {str(q): v for q, v in self.quantiles().items()},
+            'duration_histogram_minutes': self.minute_histogram().tolist(),
+            'rating_histogram': {str(r): int(c) for r, c in enumerate(self.ratings) if c},
+            'duration_by_rating': {str(r): v for r, v in self.by_rating().items()},
+        }
+
+    def to_rows(self):
+        """All statistics as (metric, key, value) rows for CSV."""
+        rows = [('tracks', '', self.tracks),
+                ('missing', 'Total Time', self.missing_duration),
+                ('missing', 'Album Rating', self.missing_rating),
+                ('rated_with_duration', '', self.paired)]
+        rows += [('duration_quantile_seconds', q, v) for q, v in self.quantiles().items()]
+        rows += [('duration_histogram_minutes', f"{m}-{m + 1}", int(c))
+                 for m, c in enumerate(self.minute_histogram())]
+        rows += [('rating_histogram', r, int(c)) for r, c in enumerate(self.ratings) if c]
+        for rating, values in self.by_rating().items():
+            rows += [(f'duration_by_rating_{name}', rating, value)
+                     for name, value in values.items()]
+        return rows
+
+    def write(self, f, fmt='json'):
+        """Write the statistics to an open text file as JSON or CSV."""
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(['metric', 'key', 'value'])
+            writer.writerows(self.to_rows())
+        else:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+    def plot(self, out_file=None):
+        """Plot rating vs duration and the duration histogram.
+
+        With out_file the figure is rendered to it with the Agg backend,
+        otherwise it is shown interactively.
+        """
+        import matplotlib
+        if out_file:
+            matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+
+        fig, axs = plt.subplots(2)
+        fig.suptitle("Playlists statistics")
+
+        # One marker per rating/minute cell, sized by its track count
+        ratings, minutes = np.nonzero(self.joint)
+        counts = self.joint[ratings, minutes]
+        axs[0].scatter(minutes + 0.5, ratings, s=5 + 40 * counts / counts.max(initial=1), c='r')
+        axs[0].axis([0, 1.05 * (minutes.max(initial=0) + 1), -1, 110])
+        axs[0].set(xlabel='Track duration', ylabel='Track rating')
+
+        # Histogram of durations in minutes
+        histogram = self.minute_histogram()
+        axs[1].bar(np.arange(len(histogram)), histogram, width=1.0, align='edge')
+        axs[1].set(xlabel='Track duration', ylabel='Count')
+        fig.tight_layout()
+
+        if out_file:
+            fig.savefig(out_file)
+            plt.close(fig)
+        else:
+            plt.show()
+
+
+def compute_stats(chunks):
+    """Accumulate TrackStats over an iterable of (durations, ratings) chunks."""
+    stats = TrackStats()
+    for durations, ratings in chunks:
+        stats.update(durations, ratings)
+    return stats
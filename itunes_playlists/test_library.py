@@ -0,0 +1,39 @@
+"""
+test_library.py
+
+Tests of comparing the playlists of a single library export, through the
+Library object, the command line and the server. Run with pytest from this
+directory.
+"""
+
+import asyncio
+import os
+
+import pytest
+
+from library import Library
+from playlists import find_common_tracks
+from server import LibraryCache, RequestError, common
+
+TEST_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files')
+# An export holding a single playlist besides the whole-library one
+SINGLE_PLAYLIST = os.path.join(TEST_FILES, 'pl1.xml')
+
+
+def test_library_needs_two_playlists():
+    with pytest.raises(ValueError, match="Need at least two playlists"):
+        Library(SINGLE_PLAYLIST, use_cache=False).common_in_playlists()
+
+
+def test_cli_needs_two_playlists(tmp_path, capsys):
+    out_file = tmp_path / 'common.txt'
+    find_common_tracks([SINGLE_PLAYLIST], use_cache=False, out_file=str(out_file))
+    assert "Need at least two playlists" in capsys.readouterr().out
+    assert not out_file.exists()
+
+
+def test_server_needs_two_playlists():
+    cache = LibraryCache(TEST_FILES, use_cache=False)
+    with pytest.raises(RequestError, match="Need at least two playlists") as error:
+        asyncio.run(common(cache, {'library': ['pl1.xml']}))
+    assert error.value.status == 400
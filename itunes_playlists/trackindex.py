@@ -0,0 +1,155 @@
+"""
+trackindex.py
+
+SQLite index of an iTunes export for ad-hoc queries.
+
+The export is streamed into a tracks table with one bulk insert inside a
+single transaction; the indexes are created after the data is in, which is
+much faster than maintaining them row by row. Repeated questions are then
+answered with index seeks instead of parsing the XML.
+"""
+
+import os
+import sqlite3
+
+from plistreader import iter_tracks
+
+DEFAULT_DB = 'itunes.db'
+
+# Column -> (SQL type, iTunes track key)
+COLUMNS = {
+    'track_id': ('INTEGER PRIMARY KEY', 'Track ID'),
+    'persistent_id': ('TEXT', 'Persistent ID'),
+    'name': ('TEXT', 'Name'),
+    'artist': ('TEXT', 'Artist'),
+    'album': ('TEXT', 'Album'),
+    'genre': ('TEXT', 'Genre'),
+    'total_time': ('INTEGER', 'Total Time'),
+    'album_rating': ('INTEGER', 'Album Rating'),
+    'rating': ('INTEGER', 'Rating'),
+    'play_count': ('INTEGER', 'Play Count'),
+    'year': ('INTEGER', 'Year'),
+    'date_added': ('TEXT', 'Date Added'),
+}
+
+INDEXES = {
+    'tracks_name': 'name',
+    'tracks_artist': 'artist, total_time',
+    'tracks_album': 'album',
+    'tracks_total_time': 'total_time',
+    'tracks_album_rating': 'album_rating',
+    'tracks_rating': 'rating',
+    'tracks_date_added': 'date_added',
+}
+
+# Named queries: (SQL, description of the arguments, default arguments)
+QUERIES = {
+    'longest': ("""
+        SELECT artist, name, total_time / 1000 AS seconds FROM (
+            SELECT artist, name, total_time, ROW_NUMBER() OVER (
+                PARTITION BY artist ORDER BY total_time DESC) AS position
+            FROM tracks WHERE artist IS NOT NULL AND total_time IS NOT NULL)
+        WHERE position <= CAST(? AS INTEGER) ORDER BY artist, position""",
+                "[N] longest tracks per artist", ['1']),
+    'unrated-albums': ("""
+        SELECT artist, album, COUNT(*) AS tracks FROM tracks
+        WHERE album IS NOT NULL GROUP BY artist, album
+        HAVING MAX(COALESCE(album_rating, rating, 0)) = 0 ORDER BY artist, album""",
+                       "albums without any rating", []),
+    'added': ("""
+        SELECT date_added, artist, name FROM tracks
+        WHERE date_added >= ? AND date_added < date(?, '+1 day') ORDER BY date_added""",
+              "FROM TO tracks added between two dates (YYYY-MM-DD)", None),
+    'artist': ("""
+        SELECT album, name, total_time / 1000 AS seconds FROM tracks
+        WHERE artist = ? ORDER BY album, name""",
+               "ARTIST tracks of an artist", None),
+}
+
+
+def _row(track):
+    """Values of a track in COLUMNS order."""
+    values = []
+    for _, key in COLUMNS.values():
+        value = track.get(key)
+        if hasattr(value, 'strftime'):
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        values.append(value)
+    return values
+
+
+def build_index(file_name, db_path=DEFAULT_DB):
+    """Import an export into the SQLite database, replacing earlier data.
+
+    The database is built in a temporary file next to db_path and moved
+    over it once complete, so a failed import leaves the previous index
+    untouched. Returns the number of tracks imported.
+    """
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        # The file is discarded on failure anyway, trade durability for
+        # import speed
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        columns = ', '.join(f'{name} {sql_type}' for name, (sql_type, _) in COLUMNS.items())
+        db.execute(f'CREATE TABLE tracks ({columns})')
+        placeholders = ', '.join('?' * len(COLUMNS))
+        db.execute('BEGIN')
+        # INSERT OR REPLACE: a Track ID can only appear once
+        db.executemany(f'INSERT OR REPLACE INTO tracks VALUES ({placeholders})',
+                       (_row(track) for track in iter_tracks(file_name)))
+        for index, columns in INDEXES.items():
+            db.execute(f'CREATE INDEX {index} ON tracks ({columns})')
+        st = os.stat(file_name)
+        db.execute('CREATE TABLE source (path TEXT, size INTEGER, mtime_ns INTEGER)')
+        db.execute('INSERT INTO source VALUES (?, ?, ?)',
+                   (os.path.abspath(file_name), st.st_size, st.st_mtime_ns))
+        db.execute('COMMIT')
+        db.execute('ANALYZE')
+        count = db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+    except BaseException:
+        db.close()
+        os.remove(tmp_path)
+        raise
+    db.close()
+    os.replace(tmp_path, db_path)
+    return count
+
+
+def run_query(db_path, name, args):
+    """Run a named query (or 'sql' with a SELECT statement).
+
+    Returns (column names, rows).
+    """
+    if not os.path.exists(db_path):
+        raise ValueError(f"No track index at {db_path}, build one with --index first")
+    if name == 'sql':
+        if len(args) != 1:
+            raise ValueError("sql takes one SELECT statement")
+        sql, args = args[0], []
+    elif name in QUERIES:
+        sql, _, defaults = QUERIES[name]
+        if not args and defaults is not None:
+            args = defaults
+    else:
+        raise ValueError(f"Unknown query {name}, expected one of: "
+                         f"{', '.join(QUERIES)}, sql")
+    # Open read-only so ad-hoc SQL can't modify the index
+    db = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        cursor = db.execute(sql, args)
+        columns = [description[0] for description in cursor.description or []]
+        return columns, cursor.fetchall()
+    except sqlite3.Error as e:
+        raise ValueError(f"Query failed: {e}")
+    finally:
+        db.close()
+
+
+def query_help():
+    """One line per named query, for the command line help."""
+    lines = [f"{name} {description}" for name, (_, description, _) in QUERIES.items()]
+    return '; '.join(lines + ["sql SELECT arbitrary read-only SQL"])
@@ -0,0 +1,396 @@
+"""
+tracktable.py
+
+Compact columnar storage for the tracks of an iTunes export.
+
+Numeric fields are kept in NumPy arrays, string fields as int32 codes into a
+pool of unique (interned) values. A table is built once from the XML and
+written to a binary cache file next to it; later runs memory map the cache
+instead of parsing the XML again.
+"""
+
+import array
+import hashlib
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+from playlistindex import PlaylistIndex
+from plistreader import iter_library
+
+# Column name -> iTunes track key
+NUMERIC_FIELDS = {
+    'track_id': 'Track ID',
+    'total_time': 'Total Time',
+    'album_rating': 'Album Rating',
+}
+STRING_FIELDS = {
+    'name': 'Name',
+    'artist': 'Artist',
+    'album': 'Album',
+}
+
+# uint64 columns identifying each track: its Persistent ID (0 if it has
+# none) and a fingerprint of all of its fields, see track_fingerprint
+ID_FIELDS = ('persistent_id', 'fingerprint')
+
+# Value stored for a missing numeric field or string code
+MISSING = -1
+
+CACHE_SUFFIX = '.tracks'
+CACHE_MAGIC = b'ITTC'
+CACHE_VERSION = 3
+# Every array in the cache file starts on a multiple of this
+ALIGNMENT = 8
+
+
+def track_fingerprint(track):
+    """64-bit hash of all fields of a track, changes when any field does."""
+    data = repr(sorted(track.items())).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+class StringColumn:
+    """A column of interned strings: per-track codes into a pool of values."""
+
+    def __init__(self, codes, offsets, data):
+        # codes: int32 per track, MISSING for no value
+        # offsets/data: the pool, value i is data[offsets[i]:offsets[i+1]]
+        self.codes = codes
+        self.offsets = offsets
+        self.data = data
+        self._values = None
+
+    @classmethod
+    def from_values(cls, codes, values):
+        """Build a column from codes and the list of unique values."""
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), np.uint8)
+        column = cls(codes, offsets, data)
+        column._values = list(values)
+        return column
+
+    @property
+    def values(self):
+        """The pool of unique values, decoded on first use."""
+        if self._values is None:
+            raw = self.data.tobytes()
+            bounds = self.offsets.tolist()
+            self._values = [raw[bounds[i]:bounds[i + 1]].decode('utf-8')
+                            for i in range(len(bounds) - 1)]
+        return self._values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        code = self.codes[index]
+        return None if code == MISSING else self.values[code]
+
+    def __iter__(self):
+        values = self.values
+        for code in self.codes.tolist():
+            yield None if code == MISSING else values[code]
+
+
+class TrackRecord:
+    """One track as a small fixed-layout object.
+
+    __slots__ leaves out the per-instance dict, and the string fields are
+    the table's interned pool values, so equal artists/albums are one object
+    shared by every record. Missing fields are None.
+    """
+
+    __slots__ = ('track_id', 'total_time', 'album_rating', 'name', 'artist', 'album',
+                 'persistent_id')
+
+    def __init__(self, track_id, total_time, album_rating, name, artist, album,
+                 persistent_id):
+        self.track_id = track_id
+        self.total_time = total_time
+        self.album_rating = album_rating
+        self.name = name
+        self.artist = artist
+        self.album = album
+        self.persistent_id = persistent_id
+
+    def __repr__(self):
+        return (f"TrackRecord({self.track_id}, {self.name!r}, {self.artist!r}, "
+                f"{self.album!r}, {self.total_time})")
+
+    def __eq__(self, other):
+        if not isinstance(other, TrackRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+class TrackTable:
+    """Columnar table of tracks with NumPy numeric and interned string columns."""
+
+    def __init__(self, columns, strings, playlists=None):
+        self.columns = columns  # name -> int32 (uint64 for ID_FIELDS) array
+        self.strings = strings  # name -> StringColumn
+        # PlaylistIndex of the export's Playlists section
+        self.playlists = playlists if playlists is not None else \
+            PlaylistIndex.from_playlists([])
+
+    def __len__(self):
+        return len(self.columns['track_id'])
+
+    def __getattr__(self, name):
+        # Expose columns as attributes, e.g. table.total_time, table.name
+        if name in ('columns', 'strings', 'playlists'):
+            raise AttributeError(name)
+        if name in self.columns:
+            return self.columns[name]
+        if name in self.strings:
+            return self.strings[name]
+        raise AttributeError(name)
+
+    def take(self, rows):
+        """A new table holding only the given rows (string pools are shared)."""
+        columns = {name: np.asarray(values)[rows] for name, values in self.columns.items()}
+        strings = {name: StringColumn(np.asarray(column.codes)[rows], column.offsets,
+                                      column.data)
+                   for name, column in self.strings.items()}
+        for name, column in strings.items():
+            column._values = self.strings[name]._values
+        return TrackTable(columns, strings, self.playlists)
+
+    def rows_of(self, track_ids):
+        """Rows of the given Track IDs (IDs not in the table are dropped)."""
+        track_id = np.asarray(self.track_id)
+        track_ids = np.asarray(track_ids)
+        order = np.argsort(track_id, kind='stable')
+        sorted_ids = track_id[order]
+        positions = np.searchsorted(sorted_ids, track_ids)
+        found = positions < len(sorted_ids)
+        found[found] = sorted_ids[positions[found]] == track_ids[found]
+        return order[positions[found]]
+
+    def keys(self):
+        """Stable identity of each track: its Persistent ID, else its Track ID."""
+        persistent = np.asarray(self.persistent_id)
+        return np.where(persistent != 0, persistent,
+                        np.asarray(self.track_id).astype(np.uint64))
+
+    def records(self, rows=None, chunk_size=4096):
+        """Yield a TrackRecord for every row (or the given rows) of the table.
+
+        Columns are converted chunk_size rows at a time, so only one chunk
+        of Python values exists besides the records that are kept.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, np.intp)
+        pools = [self.strings[name].values for name in STRING_FIELDS]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            numbers = [[None if value == MISSING else value
+                        for value in np.asarray(self.columns[name])[chunk].tolist()]
+                       for name in NUMERIC_FIELDS]
+            strings = [[None if code == MISSING else values[code]
+                        for code in np.asarray(self.strings[name].codes)[chunk].tolist()]
+                       for name, values in zip(STRING_FIELDS, pools)]
+            persistent = [f"{value:016X}" if value else None
+                          for value in np.asarray(self.persistent_id)[chunk].tolist()]
+            for fields in zip(*numbers, *strings, persistent):
+                yield TrackRecord(*fields)
+
+    @classmethod
+    def from_library(cls, items):
+        """Build a table from (section, item) pairs as yielded by iter_library."""
+        playlists = []
+
+        def tracks():
+            for section, item in items:
+                if section == 'Tracks':
+                    yield item
+                else:
+                    playlists.append(item)
+
+        table = cls.from_tracks(tracks())
+        table.playlists = PlaylistIndex.from_playlists(playlists)
+        return table
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        """Build a table from an iterable of track dicts."""
+        numbers = {name: array.array('i') for name in NUMERIC_FIELDS}
+        ids = {name: array.array('Q') for name in ID_FIELDS}
+        codes = {name: array.array('i') for name in STRING_FIELDS}
+        pools = {name: {} for name in STRING_FIELDS}
+        for track in tracks:
+            for name, key in NUMERIC_FIELDS.items():
+                numbers[name].append(int(track.get(key, MISSING)))
+            ids['persistent_id'].append(int(track.get('Persistent ID', '0'), 16))
+            ids['fingerprint'].append(track_fingerprint(track))
+            for name, key in STRING_FIELDS.items():
+                value = track.get(key)
+                if value is None:
+                    codes[name].append(MISSING)
+                else:
+                    # Intern the value: equal strings share one code
+                    pool = pools[name]
+                    codes[name].append(pool.setdefault(value, len(pool)))
+        columns = {name: np.frombuffer(values, np.int32) if values else
+                   np.zeros(0, np.int32) for name, values in numbers.items()}
+        for name, values in ids.items():
+            columns[name] = (np.frombuffer(values, np.uint64) if values
+                             else np.zeros(0, np.uint64))
+        strings = {}
+        for name in STRING_FIELDS:
+            track_codes = (np.frombuffer(codes[name], np.int32) if codes[name]
+                           else np.zeros(0, np.int32))
+            strings[name] = StringColumn.from_values(track_codes, list(pools[name]))
+        return cls(columns, strings)
+
+    def save(self, path, source):
+        """Write the table to a binary cache file.
+
+        The file holds a small JSON header (including the source key)
+        followed by the raw column arrays, so it can be memory mapped back.
+        """
+        arrays = {}
+        for name, values in self.columns.items():
+            arrays[name] = values
+        for name, column in self.strings.items():
+            arrays[f'{name}.codes'] = column.codes
+            arrays[f'{name}.offsets'] = column.offsets
+            arrays[f'{name}.data'] = column.data
+        playlists = self.playlists
+        names = StringColumn.from_values(np.arange(len(playlists), dtype=np.int32),
+                                         playlists.names)
+        arrays['playlists.ids'] = np.asarray(playlists.ids)
+        arrays['playlists.master'] = np.asarray(playlists.master, np.uint8)
+        arrays['playlists.offsets'] = np.asarray(playlists.offsets)
+        arrays['playlists.tracks'] = np.asarray(playlists.tracks)
+        arrays['playlists.names.offsets'] = names.offsets
+        arrays['playlists.names.data'] = names.data
+        # Lay out the arrays after the header, each one aligned
+        layout = {}
+        offset = 0
+        for name, values in arrays.items():
+            layout[name] = {'dtype': values.dtype.str, 'offset': offset,
+                            'length': len(values)}
+            offset += _aligned(values.nbytes)
+        header = json.dumps({'source': source, 'count': len(self),
+                             'arrays': layout}).encode('utf-8')
+        preamble = struct.pack('<4sIQ', CACHE_MAGIC, CACHE_VERSION, len(header))
+        start = _aligned(len(preamble) + len(header))
+        # Write to a temporary file first so a crash never leaves a bad cache
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(preamble)
+            f.write(header)
+            f.write(b'\0' * (start - len(preamble) - len(header)))
+            for values in arrays.values():
+                data = np.ascontiguousarray(values).tobytes()
+                f.write(data)
+                f.write(b'\0' * (_aligned(len(data)) - len(data)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory map a table from a cache file written by save()."""
+        header, start = read_cache_header(path)
+        arrays = {}
+        for name, info in header['arrays'].items():
+            if info['length'] == 0:
+                arrays[name] = np.zeros(0, np.dtype(info['dtype']))
+            else:
+                arrays[name] = np.memmap(path, np.dtype(info['dtype']), mode='r',
+                                         offset=start + info['offset'],
+                                         shape=(info['length'],))
+        columns = {name: arrays[name] for name in (*NUMERIC_FIELDS, *ID_FIELDS)}
+        strings = {name: StringColumn(arrays[f'{name}.codes'],
+                                      arrays[f'{name}.offsets'],
+                                      arrays[f'{name}.data'])
+                   for name in STRING_FIELDS}
+        names = StringColumn(None, arrays['playlists.names.offsets'],
+                             arrays['playlists.names.data'])
+        playlists = PlaylistIndex(arrays['playlists.ids'], names.values,
+                                  arrays['playlists.master'].astype(bool),
+                                  arrays['playlists.offsets'], arrays['playlists.tracks'])
+        return cls(columns, strings, playlists)
+
+
+def _aligned(size):
+    """Round size up to the next multiple of ALIGNMENT."""
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def read_cache_header(path):
+    """Return (header dict, start of array data) of a cache file."""
+    with open(path, 'rb') as f:
+        preamble = f.read(struct.calcsize('<4sIQ'))
+        magic, version, header_len = struct.unpack('<4sIQ', preamble)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError(f"{path} is not a track cache of version {CACHE_VERSION}")
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _aligned(len(preamble) + header_len)
+
+
+class _HashingReader:
+    """File wrapper that hashes everything read through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        # Hash whatever the parser did not need to read
+        while self.read(1 << 20):
+            pass
+        return self.hash.hexdigest()
+
+
+def file_digest(file_name):
+    """SHA-1 of a file's contents."""
+    with open(file_name, 'rb') as f:
+        return _HashingReader(f).hexdigest()
+
+
+def cache_path_for(file_name):
+    """Path of the cache file kept next to an export."""
+    return file_name + CACHE_SUFFIX
+
+
+def load_table(file_name, use_cache=True):
+    """Return the TrackTable of an export, using its cache when valid.
+
+    The cache is keyed on the XML's size and mtime; when only the mtime
+    differs (e.g. the file was copied or touched) the content hash decides.
+    """
+    cache_path = cache_path_for(file_name)
+    st = os.stat(file_name)
+    if use_cache and os.path.exists(cache_path):
+        try:
+            header, _ = read_cache_header(cache_path)
+            source = header['source']
+            if source['size'] == st.st_size and (
+                    source['mtime_ns'] == st.st_mtime_ns
+                    or source['sha1'] == file_digest(file_name)):
+                return TrackTable.load(cache_path)
+        except (OSError, ValueError, KeyError):
+            # Unreadable or stale cache: rebuild it below
+            pass
+    with open(file_name, 'rb') as f:
+        reader = _HashingReader(f)
+        table = TrackTable.from_library(iter_library(reader))
+        digest = reader.hexdigest()
+    if use_cache:
+        source = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': digest}
+        try:
+            table.save(cache_path, source)
+        except OSError as e:
+            print(f"Could not write track cache {cache_path}: {e}", file=sys.stderr)
+    return table
@@ -0,0 +1,167 @@
+"""
+writers.py
+
+Streamed writers for result records (duplicate groups, common tracks).
+
+Records are written one at a time through a large buffer, to a file or to
+stdout, in one of these formats:
+
+    text   the original human readable lines
+    jsonl  one JSON object per line
+    csv    a header row and one row per record (lists joined with spaces)
+    bin    compact length-prefixed binary records, see read_binary
+
+Every format can be consumed record by record, so downstream jobs never
+need to load a whole result.
+"""
+
+import contextlib
+import csv
+import io
+import json
+import os
+import struct
+import sys
+
+BUFFER_SIZE = 1 << 20
+
+FORMATS = ('text', 'jsonl', 'csv', 'bin')
+EXTENSIONS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv', '.bin': 'bin'}
+
+BINARY_MAGIC = b'ITRS'
+BINARY_VERSION = 1
+
+
+def format_for(path, fmt=None):
+    """The output format: fmt if given, else guessed from the path."""
+    if fmt:
+        return fmt
+    for extension, name in EXTENSIONS.items():
+        if path.endswith(extension):
+            return name
+    return 'text'
+
+
+@contextlib.contextmanager
+def open_output(path, binary=False):
+    """Open path for buffered writing; '-' means stdout."""
+    if path == '-':
+        stream = sys.stdout.buffer if binary else sys.stdout
+        try:
+            yield stream
+            stream.flush()
+        except BrokenPipeError:
+            # The reader went away (e.g. piped into head): stop quietly and
+            # keep Python from failing again when it flushes stdout at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    else:
+        with open(path, 'wb' if binary else 'w', buffering=BUFFER_SIZE,
+                  **({} if binary else {'encoding': 'utf-8', 'newline': ''})) as f:
+            yield f
+
+
+class TextWriter:
+    """Writes records through a format string, one per line."""
+
+    def __init__(self, f, fields, template):
+        self.f = f
+        self.template = template
+
+    def write(self, record):
+        self.f.write(self.template.format(**record) + '\n')
+
+
+class JsonLinesWriter:
+    """Writes each record as a JSON object on its own line."""
+
+    def __init__(self, f, fields, template=None):
+        self.f = f
+
+    def write(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class CsvWriter:
+    """Writes a header row, then one row per record."""
+
+    def __init__(self, f, fields, template=None):
+        self.fields = fields
+        self.writer = csv.writer(f)
+        self.writer.writerow([name for name, _ in fields])
+
+    def write(self, record):
+        self.writer.writerow([' '.join(map(str, record[name])) if kind == 'ints'
+                              else record[name] for name, kind in self.fields])
+
+
+class BinaryWriter:
+    """Writes length-prefixed binary records.
+
+    The file starts with the magic, a version and a JSON schema (list of
+    [field, kind] with kind 'str', 'int' or 'ints'). Each record is then
+    its fields in schema order: str as uint32 length + UTF-8 bytes, int as
+    int64, ints as uint32 count + int32 values. All little endian.
+    """
+
+    def __init__(self, f, fields, template=None):
+        self.f = f
+        self.fields = fields
+        schema = json.dumps(fields).encode('utf-8')
+        f.write(BINARY_MAGIC + struct.pack('<II', BINARY_VERSION, len(schema)) + schema)
+
+    def write(self, record):
+        parts = []
+        for name, kind in self.fields:
+            value = record[name]
+            if kind == 'str':
+                data = value.encode('utf-8')
+                parts.append(struct.pack('<I', len(data)) + data)
+            elif kind == 'int':
+                parts.append(struct.pack('<q', value))
+            else:
+                parts.append(struct.pack(f'<I{len(value)}i', len(value), *value))
+        self.f.write(b''.join(parts))
+
+
+WRITERS = {'text': TextWriter, 'jsonl': JsonLinesWriter, 'csv': CsvWriter,
+           'bin': BinaryWriter}
+
+
+@contextlib.contextmanager
+def record_writer(path, fields, template, fmt=None):
+    """Open a writer for records with the given fields at path ('-': stdout).
+
+    fields is a list of (name, kind) with kind 'str', 'int' or 'ints';
+    template is the format string of a line in the text format.
+    """
+    fmt = format_for(path, fmt)
+    with open_output(path, binary=fmt == 'bin') as f:
+        yield WRITERS[fmt](f, fields, template)
+
+
+def read_binary(f):
+    """Yield the records (dicts) of a binary result file one at a time."""
+    if isinstance(f, io.TextIOBase):
+        raise ValueError("read_binary needs a file opened in binary mode")
+    magic, version, length = struct.unpack('<4sII', f.read(12))
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a binary result file")
+    fields = json.loads(f.read(length).decode('utf-8'))
+    while True:
+        record = {}
+        for name, kind in fields:
+            if kind == 'int':
+                data = f.read(8)
+                if not data:
+                    return
+                record[name] = struct.unpack('<q', data)[0]
+                continue
+            data = f.read(4)
+            if not data:
+                return
+            size = struct.unpack('<I', data)[0]
+            if kind == 'str':
+                record[name] = f.read(size).decode('utf-8')
+            else:
+                record[name] = list(struct.unpack(f'<{size}i', f.read(4 * size)))
+        yield record
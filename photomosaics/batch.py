@@ -0,0 +1,238 @@
+"""
+batch.py
+
+Photomosaics of many target images against one input folder.
+
+Running photomosaic.py once per target reads the tile library again every
+time. Here the library is read once, straight at the largest tile size the
+targets need, and a thumbnail of every input at each tile size in use is
+made in memory from it. The targets are then processed by worker processes
+that share the library, and the time spent on every target is reported:
+
+    python batch.py --input-folder imgs --grid-size 30 40 a.jpg b.jpg
+    python batch.py --input-folder imgs --grid-size 30 40 --manifest targets.txt
+
+A manifest lists one target per line, optionally followed by a tab and the
+output file; blank lines and lines starting with # are skipped. Outputs
+default to <target name>-mosaic.png in --output-dir.
+"""
+
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+from photomosaic import (add_mosaic_arguments, check_grid_size, get_average_RGB, get_images,
+                         match_tiles, tile_size_for, write_mosaic)
+from tileindex import update_index
+
+
+class TileLibrary:
+    """Input images of a folder, read once and kept at every tile size used."""
+
+    def __init__(self, image_dir, use_index=True, jobs=None):
+        self.image_dir = image_dir
+        self.use_index = use_index
+        self.jobs = jobs
+        self.thumbnails = {}  # tile size -> list of PIL images
+        self.averages = None
+
+    def load(self, tile_sizes):
+        """Read the folder, with thumbnails large enough for all tile sizes."""
+        tile_sizes = set(tile_sizes)
+        largest = (max(size[0] for size in tile_sizes), max(size[1] for size in tile_sizes))
+        if self.use_index:
+            index = update_index(self.image_dir, largest, jobs=self.jobs)
+            images, averages = index.images(largest), index.averages[index.valid]
+        else:
+            images = get_images(self.image_dir, largest, self.jobs)
+            averages = np.array([get_average_RGB(img) for img in images]).reshape(-1, 3)
+        # Shuffle once to get more varied output
+        order = list(range(len(images)))
+        random.shuffle(order)
+        self.thumbnails = {largest: [images[i] for i in order]}
+        self.averages = averages[order]
+        for size in tile_sizes:
+            self.tiles(size)
+        return self
+
+    def __len__(self):
+        return 0 if self.averages is None else len(self.averages)
+
+    def tiles(self, tile_size):
+        """(thumbnails fitting in tile_size, average colors) of the inputs."""
+        if tile_size not in self.thumbnails:
+            # Reduce the thumbnails of the largest size read
+            largest = max(self.thumbnails, key=lambda size: size[0] * size[1])
+            images = []
+            for image in self.thumbnails[largest]:
+                image = image.copy()
+                image.thumbnail(tile_size)
+                images.append(image)
+            self.thumbnails[tile_size] = images
+        return self.thumbnails[tile_size], self.averages
+
+
+def read_manifest(path):
+    """(target, output or None) pairs listed in a manifest file."""
+    jobs = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            target, _, output = line.partition('\t')
+            jobs.append((target.strip(), output.strip() or None))
+    return jobs
+
+
+def default_output(target, output_dir):
+    """<output_dir>/<target name>-mosaic.png"""
+    name = os.path.splitext(os.path.basename(target))[0]
+    return os.path.join(output_dir, f'{name}-mosaic.png')
+
+
+# Library and options of a worker process, see _init_worker
+_library = None
+_options = None
+
+
+def _init_worker(library, options):
+    global _library, _options
+    _library, _options = library, options
+
+
+def make_mosaic(target, output):
+    """Build the mosaic of one target; return its timings (or error)."""
+    options = _options
+    grid_size = (int(options.grid_size[0]), int(options.grid_size[1]))
+    result = {'target': target, 'output': output}
+    start = time.perf_counter()
+    try:
+        target_image = Image.open(target)
+        target_image.load()
+        check_grid_size(target_image.size, grid_size)
+        input_images, input_avgs = _library.tiles(tile_size_for(target_image.size, grid_size))
+        if not options.reuse_images and grid_size[0]*grid_size[1] > len(input_images):
+            raise ValueError(f"Not enough input images ({len(input_images)}) for a "
+                             f"{grid_size[0]}x{grid_size[1]} grid without reuse.")
+        loaded = time.perf_counter()
+        match_indices = match_tiles(target_image, input_images, grid_size,
+                                    options.reuse_images, input_avgs, options.features,
+                                    options.cells)
+        matched = time.perf_counter()
+        result['output'] = write_mosaic(input_images, match_indices, grid_size, output,
+                                        options.output_mode)
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+    written = time.perf_counter()
+    result.update(load=loaded - start, match=matched - loaded, write=written - matched,
+                  total=written - start)
+    return result
+
+
+def run_batch(jobs, library, options, workers=None):
+    """Run make_mosaic for (target, output) pairs; yield results as they finish.
+
+    Targets are processed by workers processes (default: one per CPU),
+    which share the loaded library.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        _init_worker(library, options)
+        for target, output in jobs:
+            yield make_mosaic(target, output)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(library, options)) as pool:
+        futures = [pool.submit(make_mosaic, target, output) for target, output in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def print_timings(results, load_time):
+    """Table of the time spent on every target."""
+    print(f"\nlibrary: {load_time:.2f} s")
+    print(f"{'target':<40} {'load':>7} {'match':>7} {'write':>7} {'total':>7}")
+    for result in results:
+        target = result['target'][-40:]
+        if 'error' in result:
+            print(f"{target:<40} failed: {result['error']}")
+        else:
+            print(f"{target:<40} " + ' '.join(f"{result[stage]:>7.2f}" for stage in
+                                              ('load', 'match', 'write', 'total')))
+
+
+def main():
+    """Create photomosaics for many targets from the same input images."""
+    parser = argparse.ArgumentParser(
+        description="Creates photomosaics of many target images from one input folder.")
+    parser.add_argument('targets', nargs='*', help="Target images")
+    parser.add_argument('--manifest', dest='manifest',
+                        help="File listing targets (and output files), one per line")
+    parser.add_argument('--output-dir', dest='output_dir', default='.',
+                        help="Directory of the outputs not named in the manifest")
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help="Targets processed in parallel (default: one per CPU)")
+    add_mosaic_arguments(parser)
+
+    args = parser.parse_args()
+
+    jobs = [(target, None) for target in args.targets]
+    if args.manifest:
+        jobs += read_manifest(args.manifest)
+    if not jobs:
+        parser.error("No target images given")
+    jobs = [(target, output or default_output(target, args.output_dir))
+            for target, output in jobs]
+    outputs = [output for _, output in jobs]
+    if len(set(outputs)) != len(outputs):
+        parser.error("Several targets would be written to the same output file")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Tile size of every target, from the image headers; targets too small
+    # for the grid are reported and skipped
+    grid_size = (int(args.grid_size[0]), int(args.grid_size[1]))
+    tile_sizes, valid_jobs, results = [], [], []
+    for target, output in jobs:
+        try:
+            with Image.open(target) as target_image:
+                check_grid_size(target_image.size, grid_size)
+                tile_sizes.append(tile_size_for(target_image.size, grid_size))
+        except OSError:
+            # Reported when the target is processed
+            pass
+        except ValueError as e:
+            print(f"{target}: {e}")
+            results.append({'target': target, 'output': output, 'error': str(e)})
+            continue
+        valid_jobs.append((target, output))
+    jobs = valid_jobs
+    if not tile_sizes:
+        print("No usable target images")
+        exit()
+
+    print('reading input folder...')
+    start = time.perf_counter()
+    library = TileLibrary(args.input_folder, args.use_index, args.jobs).load(tile_sizes)
+    load_time = time.perf_counter() - start
+    if not len(library):
+        print(f"No input images found in {args.input_folder}")
+        exit()
+
+    for result in run_batch(jobs, library, args, args.workers):
+        if 'error' in result:
+            print(f"{result['target']}: {result['error']}")
+        else:
+            print(f"saved output to {result['output']} ({result['total']:.2f} s)")
+        results.append(result)
+    print_timings(results, load_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+bench.py
+
+Benchmarks for photomosaic.py on synthetic input libraries and targets.
+
+A folder of input images and a target image of the requested sizes are
+generated, then every stage of making a mosaic is timed separately:
+reading the folder (get_images), shrinking the inputs to tile size
+(resize), decoding straight to tile size and loading the tile index,
+cutting the target (split_image, get_tile_averages), matching,
+assembling the mosaic (create_image_grid), saving it, and streaming it
+band by band instead. Wall times go into a JSON report, which can be
+compared against the report of an earlier run; with --profile a cProfile
+dump of every stage is written as well (read them with python -m pstats).
+
+    python bench.py --images 2000 --grid-size 60 80 --out after.json --compare before.json
+"""
+
+import argparse
+import contextlib
+import cProfile
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from features import FEATURES
+from mosaicwriter import MosaicBands, write_png
+from photomosaic import (create_image_grid, get_images, get_tile_averages, match_tiles,
+                         split_image, tile_size_for)
+from tileindex import update_index
+
+
+def _smooth_image(rng, width, height, waves=3):
+    # A few random color gradients and waves, plus some grain, so images
+    # have structure (for --feature-grid) and compress like photos
+    y, x = np.mgrid[0:1:height * 1j, 0:1:width * 1j]
+    pixels = np.empty((height, width, 3))
+    for channel in range(3):
+        value = rng.uniform(0, 255) + rng.uniform(-80, 80) * x + rng.uniform(-80, 80) * y
+        for _ in range(waves):
+            fx, fy, phase = rng.uniform(0, 6, 2).tolist() + [rng.uniform(0, 2 * np.pi)]
+            value += rng.uniform(0, 40) * np.sin(2 * np.pi * (fx * x + fy * y) + phase)
+        pixels[:, :, channel] = value
+    pixels += rng.normal(0, 4, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def generate_library(image_dir, images, image_size=(320, 240), seed=0):
+    """Write images synthetic JPEGs of image_size (width, height) to a folder."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    for number in range(images):
+        _smooth_image(rng, *image_size).save(
+            os.path.join(image_dir, f'image{number:06d}.jpg'), quality=90)
+
+
+def generate_target(path, target_size=(1920, 1440), seed=0):
+    """Write a synthetic target JPEG of target_size (width, height)."""
+    rng = np.random.default_rng(seed + 1)
+    _smooth_image(rng, *target_size, waves=6).save(path, quality=90)
+
+
+def measure(func, repeat=1, profile_path=None):
+    """Run func, return (result, best wall time in s).
+
+    With profile_path, func is run once more under cProfile and the stats
+    are dumped there, so profiling doesn't distort the timings. Progress
+    messages printed by the code under test are discarded.
+    """
+    best = float('inf')
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+        if profile_path:
+            gc.collect()
+            profiler = cProfile.Profile()
+            profiler.runcall(func)
+            profiler.dump_stats(profile_path)
+    return result, best
+
+
+def thumbnails(images, tile_size):
+    """Copies of images shrunk to fit in tile_size, as photomosaic.py used to."""
+    resized = []
+    for image in images:
+        image = image.copy()
+        image.thumbnail(tile_size)
+        resized.append(image)
+    return resized
+
+
+def run_benchmarks(image_dir, target_path, grid_size, repeat=1, jobs=None, features='rgb',
+                   cells=1, reuse_images=True, profile_dir=None):
+    """Time each stage on a library and target; return {stage: {seconds}}."""
+    results = {}
+    target_image = Image.open(target_path)
+    target_image.load()
+    tile_size = tile_size_for(target_image.size, grid_size)
+
+    def record(stage, func):
+        profile_path = os.path.join(profile_dir, f'{stage}.pstats') if profile_dir else None
+        result, seconds = measure(func, repeat, profile_path)
+        results[stage] = {'seconds': round(seconds, 4)}
+        print(f"{stage:>17}: {seconds:8.3f} s")
+        return result
+
+    # Full decode of every input, then the resize to tile size
+    images = record('get_images', lambda: get_images(image_dir))
+    record('resize', lambda: thumbnails(images, tile_size))
+    images = None  # release the full size images
+    record('get_images_thumb', lambda: get_images(image_dir, tile_size, jobs))
+    # Build the index once, then time loading it back
+    with contextlib.redirect_stdout(io.StringIO()):
+        update_index(image_dir, tile_size, jobs=jobs)
+    index = record('index_load', lambda: update_index(image_dir, tile_size, jobs=jobs))
+    input_images, input_avgs = index.images(tile_size), index.averages[index.valid]
+
+    record('split_image', lambda: split_image(target_image, grid_size))
+    record('tile_averages', lambda: get_tile_averages(target_image, grid_size))
+    match_indices = record('matching', lambda: match_tiles(
+        target_image, input_images, grid_size, reuse_images, input_avgs, features, cells))
+    mosaic_image = record('create_image_grid', lambda: create_image_grid(
+        [input_images[index] for index in match_indices.tolist()], grid_size))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, 'mosaic.png')
+        record('save', lambda: mosaic_image.save(output_path, 'PNG'))
+        bands = MosaicBands(input_images, match_indices, grid_size)
+        record('write_bands', lambda: write_png(output_path, bands.size, bands))
+    return results
+
+
+def compare_reports(old, new):
+    """Print the change of each stage between two reports."""
+    print(f"{'stage':>17}  {'old s':>9} {'new s':>9} {'ratio':>7}")
+    for stage, now in new['results'].items():
+        before = old['results'].get(stage)
+        if before is None:
+            continue
+        ratio = now['seconds'] / before['seconds'] if before['seconds'] else float('nan')
+        print(f"{stage:>17}  {before['seconds']:9.3f} {now['seconds']:9.3f} {ratio:7.2f}")
+
+
+def main():
+    """Generate a library and a target and benchmark photomosaic.py on them."""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks photomosaic.py on a synthetic input library and target.")
+    parser.add_argument('--images', type=int, default=1000, help="Input images to generate")
+    parser.add_argument('--image-size', dest='image_size', type=int, nargs=2,
+                        default=[320, 240], help="Width and height of the input images")
+    parser.add_argument('--target-size', dest='target_size', type=int, nargs=2,
+                        default=[1920, 1440], help="Width and height of the target")
+    parser.add_argument('--grid-size', dest='grid_size', type=int, nargs=2, default=[60, 80],
+                        help="Rows and columns of the mosaic")
+    parser.add_argument('--features', choices=FEATURES, default='rgb')
+    parser.add_argument('--feature-grid', dest='cells', type=int, choices=[1, 2, 4],
+                        default=1)
+    parser.add_argument('--no-reuse', dest='reuse_images', action='store_false')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Processes decoding input images (default: one per CPU)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="Keep the best of N timings")
+    parser.add_argument('--data-dir', dest='data_dir',
+                        help="Keep the generated images here (reused if they exist)")
+    parser.add_argument('--profile', dest='profile_dir',
+                        help="Write a cProfile dump of every stage to this directory")
+    parser.add_argument('--out', default='bench.json', help="JSON report to write")
+    parser.add_argument('--compare', help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+    if not args.reuse_images and args.grid_size[0] * args.grid_size[1] > args.images:
+        parser.error(f"--no-reuse needs at least {args.grid_size[0] * args.grid_size[1]} "
+                     "images for this grid")
+
+    config = {name: getattr(args, name)
+              for name in ('images', 'image_size', 'target_size', 'grid_size', 'features',
+                           'cells', 'reuse_images', 'seed')}
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        # The data depends on the generation settings only
+        name = f"{args.images}x{args.image_size[0]}x{args.image_size[1]}-seed{args.seed}"
+        image_dir = os.path.join(data_dir, name)
+        target_path = os.path.join(
+            data_dir, f"target-{args.target_size[0]}x{args.target_size[1]}-seed{args.seed}.jpg")
+        if not os.path.isdir(image_dir):
+            print(f"generating {args.images} images...")
+            start = time.perf_counter()
+            # Generate into a temporary folder first so an interrupted run is
+            # not mistaken for a complete library
+            generate_library(image_dir + '.tmp', args.images, args.image_size, args.seed)
+            os.replace(image_dir + '.tmp', image_dir)
+            print(f"generated in {time.perf_counter() - start:.1f} s")
+        if not os.path.exists(target_path):
+            generate_target(target_path, args.target_size, args.seed)
+        results = run_benchmarks(image_dir, target_path, tuple(args.grid_size), args.repeat,
+                                 args.jobs, args.features, args.cells, args.reuse_images,
+                                 args.profile_dir)
+
+    report = {
+        'config': config,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"report written to {args.out}")
+    if args.profile_dir:
+        print(f"profiles written to {args.profile_dir}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
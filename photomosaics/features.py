@@ -0,0 +1,67 @@
+"""
+features.py
+
+Feature vectors describing target tiles and input images for matching.
+
+The default description is the average RGB color. For structure-aware
+matching each tile/image is instead cut into a small grid of cells (2x2 or
+4x4) and described by the CIE Lab color of every cell, so e.g. a tile that
+is dark on top and light below matches images with the same layout, and
+distances follow perceived color differences more closely than RGB.
+
+Everything is computed on arrays: the target's cells come from one block
+reduction over the whole image, input images are reduced to their cell
+grid with Pillow's box filter, and the Lab conversion is a few NumPy
+operations over all cells at once.
+"""
+
+import numpy as np
+from PIL import Image
+
+FEATURES = ('rgb', 'lab')
+
+# sRGB (D65) to XYZ, and the D65 white point
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgb_to_lab(rgb):
+    """Convert an array of sRGB colors (0-255, last axis) to CIE Lab."""
+    rgb = np.asarray(rgb, np.float64) / 255
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def _describe(cells, features):
+    # cells: (count, cells, cells, 3) sRGB averages -> (count, length) vectors
+    if features == 'lab':
+        cells = rgb_to_lab(cells)
+    return cells.reshape(len(cells), -1)
+
+
+def tile_features(cell_averages, grid_size, cells=1, features='rgb'):
+    """Feature vector of every target tile, in row-major tile order.
+
+    cell_averages is the (m*cells, n*cells, 3) array of average colors of
+    the target cut into grid_size tiles of cells x cells cells each (see
+    photomosaic.get_tile_averages).
+    """
+    m, n = grid_size
+    grid = np.asarray(cell_averages).reshape(m, cells, n, cells, 3)
+    return _describe(grid.transpose(0, 2, 1, 3, 4).reshape(m * n, cells, cells, 3),
+                     features)
+
+
+def image_features(images, cells=1, features='rgb'):
+    """Feature vector of every input image (PIL images)."""
+    grids = np.empty((len(images), cells, cells, 3))
+    for i, image in enumerate(images):
+        # The box filter averages the pixels covered by each cell
+        grids[i] = np.asarray(image.convert('RGB').resize((cells, cells), Image.BOX))
+    return _describe(grids, features)
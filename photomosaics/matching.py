@@ -0,0 +1,217 @@
+"""
+matching.py
+
+Nearest-neighbour matching of target tiles against the input images.
+
+Every input image is described by a feature vector (its average RGB color),
+and all target tiles are matched in one batched query instead of one Python
+loop over the library per tile. Low-dimensional features are indexed in a
+k-d tree. Longer feature vectors (see features.py), where k-d trees degrade
+to a linear scan, are projected on their main principal components for the
+tree, and the candidates it returns are re-ranked on the full vectors. Small
+libraries, or exact=True, use blocks of (BLAS) matrix products instead.
+
+When inputs may not be reused, tiles are assigned to images globally (see
+assign_unique) rather than greedily in tile order.
+"""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+
+# Above this many dimensions features are projected for the k-d tree
+KDTREE_MAX_DIMS = 8
+PROJECTED_DIMS = 8
+# Candidates from the projected tree re-ranked on the full vectors, and the
+# approximation allowed in that search (see cKDTree.query's eps)
+RERANK = 16
+RERANK_EPS = 1.0
+# Long feature vectors of at most this many inputs are compared exhaustively
+BRUTE_FORCE_MAX = 4096
+# Target tiles per block of the brute-force search, bounds its scratch memory
+BLOCK_SIZE = 1024
+# No-reuse assignment: solved exactly up to this many target x input pairs,
+# otherwise greedily over this many nearest candidates per target
+EXACT_MAX_CELLS = 4_000_000
+CANDIDATES = 16
+# Targets x inputs of a group of competing targets shared out exactly, see
+# assign_unique
+GROUP_EXACT_MAX_CELLS = 1 << 18
+
+
+class TileMatcher:
+    """Index of input image features answering batched nearest queries."""
+
+    def __init__(self, features, exact=False):
+        self.features = np.asarray(features, np.float64)
+        if self.features.ndim == 1:
+            self.features = self.features[:, None]
+        self.projection = None
+        if self.features.shape[1] <= KDTREE_MAX_DIMS:
+            self.tree = cKDTree(self.features)
+        elif not exact and len(self.features) > BRUTE_FORCE_MAX:
+            # Principal axes of (a sample of) the features
+            sample = self.features[np.random.default_rng(0).permutation(
+                len(self.features))[:BRUTE_FORCE_MAX]]
+            self.mean = sample.mean(axis=0)
+            _, _, axes = np.linalg.svd(sample - self.mean, full_matrices=False)
+            self.projection = axes[:PROJECTED_DIMS].T
+            self.tree = cKDTree((self.features - self.mean) @ self.projection)
+        else:
+            self.tree = None
+            self.features32 = self.features.astype(np.float32)
+            self.norms = np.einsum('ij,ij->i', self.features32, self.features32)
+
+    def __len__(self):
+        return len(self.features)
+
+    def query(self, targets, k=1):
+        """Indices of the k nearest inputs of each target (and distances²).
+
+        Returns two arrays of shape (len(targets), k), nearest first.
+        """
+        targets = np.asarray(targets, np.float64).reshape(-1, self.features.shape[1])
+        k = min(k, len(self))
+        if self.projection is not None:
+            distances, indices = self._rerank(targets, k)
+        elif self.tree is not None:
+            distances, indices = self.tree.query(targets, k=k, workers=-1)
+            distances = distances ** 2
+        else:
+            distances, indices = self._brute_force(targets, k)
+        return indices.reshape(len(targets), k), distances.reshape(len(targets), k)
+
+    def _rerank(self, targets, k):
+        count = min(max(k, RERANK), len(self))
+        _, candidates = self.tree.query((targets - self.mean) @ self.projection, k=count,
+                                        eps=RERANK_EPS, workers=-1)
+        candidates = candidates.reshape(len(targets), count)
+        diffs = self.features[candidates] - targets[:, None, :]
+        squared = np.einsum('ijk,ijk->ij', diffs, diffs)
+        order = np.argsort(squared, axis=1, kind='stable')[:, :k]
+        return (np.take_along_axis(squared, order, axis=1),
+                np.take_along_axis(candidates, order, axis=1))
+
+    def _brute_force(self, targets, k):
+        # argmin |t - f|² = argmin |f|² - 2 t.f, one float32 matrix product
+        # per block; the distances of the chosen inputs are then computed
+        # exactly
+        indices = np.empty((len(targets), k), np.intp)
+        for start in range(0, len(targets), BLOCK_SIZE):
+            block = targets[start:start + BLOCK_SIZE].astype(np.float32)
+            squared = self.norms[None, :] - 2 * (block @ self.features32.T)
+            if k == 1:
+                nearest = np.argmin(squared, axis=1)[:, None]
+            elif k < len(self):
+                nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            else:
+                nearest = np.tile(np.arange(len(self)), (len(block), 1))
+            order = np.argsort(np.take_along_axis(squared, nearest, axis=1), axis=1,
+                               kind='stable')
+            indices[start:start + BLOCK_SIZE] = np.take_along_axis(nearest, order, axis=1)
+        diffs = self.features[indices] - targets[:, None, :]
+        return np.einsum('ijk,ijk->ij', diffs, diffs), indices
+
+    def nearest(self, targets):
+        """Index of the nearest input of each target."""
+        return self.query(targets)[0][:, 0]
+
+
+def squared_distances(targets, features):
+    """Matrix of squared distances between two sets of feature vectors.
+
+    Computed as |t|² + |f|² - 2 t.f with one matrix product, so no
+    (targets x inputs x dimensions) array is built.
+    """
+    squared = np.einsum('ij,ij->i', targets, targets)[:, None] \
+        + np.einsum('ij,ij->i', features, features)[None, :] - 2 * (targets @ features.T)
+    return np.maximum(squared, 0, out=squared)
+
+
+def assign_unique(targets, features, k=CANDIDATES):
+    """Match every target to a different input; return the input indices.
+
+    Small problems are solved exactly with scipy's linear_sum_assignment
+    on the full distance matrix. Larger ones use a global greedy pass over
+    the k nearest candidates of each target: all (target, candidate) pairs
+    are taken in order of distance, the same order a priority queue would
+    pop them in, and a pair is kept if neither side is taken yet.
+
+    Targets left without a free candidate are then grouped by the unused
+    input nearest to them; these are targets competing for the same
+    inputs, e.g. the tiles of a flat background. Every group of g targets
+    asks for the g + k - 1 free inputs nearest to its mean at once (twice
+    as many each time it is left short again), takes them greedily in the
+    same way and shares them among its targets: optimally, or for groups
+    too large for that, in order along the targets' main axis.
+    """
+    targets = np.asarray(targets, np.float64).reshape(len(targets), -1)
+    features = np.asarray(features, np.float64).reshape(len(features), -1)
+    if len(targets) > len(features):
+        raise ValueError(f"Need at least {len(targets)} input images, got {len(features)}")
+    if len(targets) * len(features) <= EXACT_MAX_CELLS:
+        _, assignment = linear_sum_assignment(squared_distances(targets, features))
+        return assignment
+
+    assignment = np.full(len(targets), -1, np.intp)
+    used = np.zeros(len(features), bool)
+    pending = np.arange(len(targets))
+    scale = 0  # first round: every target on its own
+    while len(pending):
+        free = np.flatnonzero(~used)
+        matcher = TileMatcher(features[free])
+        if scale:
+            _, group_of = np.unique(matcher.nearest(targets[pending]), return_inverse=True)
+            order = np.argsort(group_of.reshape(-1), kind='stable')
+            members = pending[order]
+            sizes = np.bincount(group_of.reshape(-1))
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+            centers = np.add.reduceat(targets[members], starts, axis=0) / sizes[:, None]
+            counts = np.minimum(sizes * scale + k - 1, len(free))
+        else:
+            members, sizes, starts = pending, np.ones(len(pending), np.intp), \
+                np.arange(len(pending))
+            centers, counts = targets[pending], np.full(len(pending), min(k, len(free)))
+        # Query the groups by powers of two of their number of candidates
+        rounded = np.minimum(2 ** np.ceil(np.log2(counts)).astype(np.int64), len(free))
+        groups, candidates, distances = [], [], []
+        for count in np.unique(rounded).tolist():
+            batch = np.flatnonzero(rounded == count)
+            indices, batch_distances = matcher.query(centers[batch], count)
+            groups.append(np.repeat(batch, count))
+            candidates.append(free[indices.reshape(-1)])
+            distances.append(batch_distances.reshape(-1))
+        # Every (group, candidate) pair, nearest first
+        order = np.argsort(np.concatenate(distances), kind='stable')
+        taken = [[] for _ in range(len(sizes))]
+        for group, candidate in zip(np.concatenate(groups)[order].tolist(),
+                                    np.concatenate(candidates)[order].tolist()):
+            if len(taken[group]) < sizes[group] and not used[candidate]:
+                taken[group].append(candidate)
+                used[candidate] = True
+        for group, chosen in enumerate(taken):
+            if not chosen:
+                continue
+            group_members = members[starts[group]:starts[group] + sizes[group]]
+            chosen = np.array(chosen)
+            if len(group_members) == 1:
+                assignment[group_members] = chosen
+            elif len(group_members) * len(chosen) <= GROUP_EXACT_MAX_CELLS:
+                rows, columns = linear_sum_assignment(
+                    squared_distances(targets[group_members], features[chosen]))
+                assignment[group_members[rows]] = chosen[columns]
+            else:
+                # Pair targets and inputs in order along the main axis of
+                # the group's targets (spread evenly over the targets when
+                # there are fewer inputs)
+                spread = targets[group_members] - centers[group]
+                axis = np.linalg.svd(spread, full_matrices=False)[2][0]
+                by_target = np.argsort(spread @ axis, kind='stable')
+                by_target = by_target[np.linspace(0, len(by_target) - 1,
+                                                  len(chosen)).round().astype(np.intp)]
+                by_input = np.argsort((features[chosen] - centers[group]) @ axis,
+                                      kind='stable')
+                assignment[group_members[by_target]] = chosen[by_input]
+        pending = pending[assignment[pending] < 0]
+        scale = 2 * scale or 1
+    return assignment
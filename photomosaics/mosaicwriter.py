@@ -0,0 +1,182 @@
+"""
+mosaicwriter.py
+
+Streaming output for mosaics too large to hold in memory.
+
+create_image_grid builds the whole mosaic as one image, e.g. 24 GB for a
+500x500 grid of 128x128 tiles. Here the mosaic is rendered one band (one
+row of tiles) at a time from the matched tile indices and the input
+thumbnails, and each band is written out before the next one is made, so
+peak memory is bounded by one band whatever the size of the grid:
+
+- write_png streams the bands into a single PNG file, compressing the
+  scanlines as they come.
+- write_deepzoom writes a DeepZoom pyramid (a .dzi descriptor and a
+  _files directory of tiles per zoom level) for image viewers such as
+  OpenSeadragon. The full resolution level is cut from the bands, every
+  lower level is then built from the 2x2 tiles above it on disk.
+"""
+
+import math
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+PNG_COMPRESSION = 6
+DEEPZOOM_TILE_SIZE = 256
+DEEPZOOM_FORMAT = 'jpg'
+
+
+class MosaicBands:
+    """The rows of tiles of a mosaic, rendered one band at a time.
+
+    indices holds the input image of every tile in row-major order (see
+    photomosaic.match_tiles). Tiles are laid out as in create_image_grid:
+    every cell is as large as the largest image used, and images are
+    pasted at the top left corner of their cell.
+    """
+
+    def __init__(self, images, indices, grid_size):
+        m, n = grid_size
+        self.images = images
+        self.indices = np.asarray(indices).reshape(m, n)
+        used = np.unique(self.indices).tolist()
+        self.tile_width = max(images[i].size[0] for i in used)
+        self.tile_height = max(images[i].size[1] for i in used)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def size(self):
+        """(width, height) of the whole mosaic."""
+        m, n = self.indices.shape
+        return n * self.tile_width, m * self.tile_height
+
+    def band(self, row):
+        """Row row of the grid as one image of the mosaic's width."""
+        band = Image.new('RGB', (self.size[0], self.tile_height))
+        for col, index in enumerate(self.indices[row].tolist()):
+            band.paste(self.images[index], (col * self.tile_width, 0))
+        return band
+
+    def __iter__(self):
+        return (self.band(row) for row in range(len(self)))
+
+
+def _png_chunk(f, kind, data):
+    f.write(struct.pack('>I', len(data)) + kind + data)
+    f.write(struct.pack('>I', zlib.crc32(kind + data)))
+
+
+def write_png(path, size, bands, compression=PNG_COMPRESSION):
+    """Write RGB bands (top to bottom, each size[0] wide) as one PNG file."""
+    width, height = size
+    compressor = zlib.compressobj(compression)
+    written = 0
+    previous = np.zeros(3 * width, np.uint8)  # the row above the image is zero
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bit RGB, not interlaced
+        _png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        for band in bands:
+            pixels = np.asarray(band.convert('RGB'), np.uint8).reshape(band.size[1], -1)
+            # Every scanline with the Up filter: the difference of each byte
+            # with the byte above it (mod 256)
+            scanlines = np.empty((len(pixels), 1 + pixels.shape[1]), np.uint8)
+            scanlines[:, 0] = 2
+            np.subtract(pixels[:1], previous, out=scanlines[:1, 1:])
+            np.subtract(pixels[1:], pixels[:-1], out=scanlines[1:, 1:])
+            previous = pixels[-1]
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                _png_chunk(f, b'IDAT', data)
+            written += len(pixels)
+        _png_chunk(f, b'IDAT', compressor.flush())
+        _png_chunk(f, b'IEND', b'')
+    if written != height:
+        raise ValueError(f"Got {written} rows of pixels for a PNG {height} pixels high")
+
+
+def deepzoom_paths(path):
+    """Paths of the .dzi descriptor and the tile directory of a DeepZoom image."""
+    base = os.path.splitext(path)[0]
+    return base + '.dzi', base + '_files'
+
+
+def _level_sizes(size):
+    # (width, height) of every level, level 0 being 1x1 pixel
+    width, height = size
+    levels = math.ceil(math.log2(max(width, height, 1))) + 1
+    return [(math.ceil(width / 2 ** (levels - 1 - level)),
+             math.ceil(height / 2 ** (levels - 1 - level))) for level in range(levels)]
+
+
+def _tile_path(files_dir, level, col, row, fmt):
+    return os.path.join(files_dir, str(level), f'{col}_{row}.{fmt}')
+
+
+def write_deepzoom(path, size, bands, tile_size=DEEPZOOM_TILE_SIZE, fmt=DEEPZOOM_FORMAT):
+    """Write RGB bands (top to bottom) as a DeepZoom image pyramid.
+
+    Writes path with a .dzi extension and the tiles to the <name>_files
+    directory next to it; returns the path of the .dzi file. Tiles are
+    tile_size pixels square without overlap.
+    """
+    dzi_path, files_dir = deepzoom_paths(path)
+    sizes = _level_sizes(size)
+    top = len(sizes) - 1
+    for level in range(len(sizes)):
+        os.makedirs(os.path.join(files_dir, str(level)), exist_ok=True)
+
+    def save_tile_row(strip, row):
+        for col, x in enumerate(range(0, size[0], tile_size)):
+            Image.fromarray(strip[:, x:x + tile_size]).save(
+                _tile_path(files_dir, top, col, row, fmt))
+
+    # Full resolution: gather the rows of pixels of the bands into strips
+    # one tile high and cut them into tiles
+    strip, filled, row = [], 0, 0
+    for band in bands:
+        pixels = np.asarray(band.convert('RGB'), np.uint8)
+        while len(pixels):
+            take = min(tile_size - filled, len(pixels))
+            strip.append(pixels[:take])
+            pixels = pixels[take:]
+            filled += take
+            if filled == tile_size:
+                save_tile_row(np.concatenate(strip), row)
+                strip, filled, row = [], 0, row + 1
+    if filled:
+        save_tile_row(np.concatenate(strip), row)
+
+    # Every lower level halves the one above: each tile is the 2x2 tiles
+    # it covers one level up, reduced by 2
+    for level in range(top - 1, -1, -1):
+        width, height = sizes[level]
+        above_width, above_height = sizes[level + 1]
+        for row in range(math.ceil(height / tile_size)):
+            for col in range(math.ceil(width / tile_size)):
+                x, y = 2 * col * tile_size, 2 * row * tile_size
+                block = Image.new('RGB', (min(2 * tile_size, above_width - x),
+                                          min(2 * tile_size, above_height - y)))
+                for dy in range(2):
+                    for dx in range(2):
+                        tile_path = _tile_path(files_dir, level + 1, 2 * col + dx,
+                                               2 * row + dy, fmt)
+                        if os.path.exists(tile_path):
+                            with Image.open(tile_path) as tile:
+                                block.paste(tile, (dx * tile_size, dy * tile_size))
+                block.resize((math.ceil(block.size[0] / 2), math.ceil(block.size[1] / 2)),
+                             Image.BOX).save(_tile_path(files_dir, level, col, row, fmt))
+
+    with open(dzi_path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                f'Format="{fmt}" Overlap="0" TileSize="{tile_size}">\n'
+                f'  <Size Width="{size[0]}" Height="{size[1]}"/>\n'
+                '</Image>\n')
+    return dzi_path
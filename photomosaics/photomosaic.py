@@ -4,21 +4,40 @@ from PIL import Image
 import numpy as np
 import argparse
 
+from features import FEATURES, image_features, tile_features
+from matching import TileMatcher, assign_unique
+from mosaicwriter import MosaicBands, write_deepzoom, write_png
+from tileindex import load_tiles, update_index
 
-def get_images(image_dir):
-    """Given a directory of images, return a list of Images."""
+
+def get_images(image_dir, tile_size=None, jobs=None):
+    """Given a directory of images, return a list of Images.
+
+    With tile_size, each image is decoded straight to a thumbnail that
+    fits in it and nothing larger is kept. Images are decoded by jobs
+    worker processes (default: one per CPU).
+    """
     files = os.listdir(image_dir)  # gathet files in the image_dir directory
+    # Get complete filename of the images
+    file_paths = [os.path.abspath(os.path.join(image_dir, file)) for file in files
+                  if not file.startswith('.')]
+    if tile_size is not None:
+        images = []
+        for file_path, tile in zip(file_paths, load_tiles(file_paths, tile_size, jobs)):
+            if tile is None:
+                print(f"Invalid image: {file_path}")
+            else:
+                images.append(Image.fromarray(tile[1]))
+        return images
     images = []
-    for file in files:
-        # Get complete filename of the image
-        file_path = os.path.abspath(os.path.join(image_dir, file))
+    for file_path in file_paths:
         try:
             with open(file_path, 'rb') as f:
                 im = Image.open(f)
-                images.append(im)
                 # Force loading the image data from file
                 im.load()
-        except:
+                images.append(im)
+        except (OSError, ValueError):
             print(f"Invalid image: {file_path}")
     return images
 
@@ -33,38 +52,53 @@ def get_average_RGB(image):
     return tuple(np.average(im.reshape(w*h, d), axis=0))
 
 
+def tile_edges(length, count):
+    """Pixel boundaries of count tiles over length pixels.
+
+    When length isn't a multiple of count the leftover pixels are spread
+    over the tiles (sizes differ by at most one), so no pixel is dropped.
+    """
+    return np.arange(count + 1) * length // count
+
+
 def split_image(image, size):
-    """Split the target image into a grid m*n of smaller images."""
+    """Split the target image into a grid of m rows * n columns of smaller images."""
     width, height = image.size[0], image.size[1]
     m, n = size
-    tile_width, tile_height = int(width/m), int(height/n)
+    xs, ys = tile_edges(width, n).tolist(), tile_edges(height, m).tolist()
     # Image list
     imgs = []
     for j in range(m):
         for i in range(n):
             # Append cropped image
-            imgs.append(image.crop((i*tile_width, j*tile_height,
-                        (i+1)*tile_width, (j+1)*tile_height)))
+            imgs.append(image.crop((xs[i], ys[j], xs[i+1], ys[j+1])))
     return imgs
 
 
-def get_best_match_index(input_avg, avgs):
-    """Find the bast match for a tile from the folder of input images."""
-    # Input innage average
-    avg = input_avg
+def check_grid_size(image_size, grid_size):
+    """Raise ValueError unless an image of image_size can be cut into grid_size."""
+    m, n = grid_size
+    if not (0 < m <= image_size[1] and 0 < n <= image_size[0]):
+        raise ValueError(f"Can't split a {image_size[0]}x{image_size[1]} image "
+                         f"into {m} rows and {n} columns")
 
-    # Get the closest RGB value to input, based on RGB distance
-    index = 0
-    min_index = 0
-    min_dist = float("inf")  # minim distance to infinity
-    for val in avgs:
-        dist = ((val[0] - avg[0])*(val[0] - avg[0]) + (val[1] - avg[1])
-                * (val[1] - avg[1]) + (val[2] - avg[2])*(val[2] - avg[2]))
-        if dist < min_dist:
-            min_dist = dist
-            min_index = index
-        index += 1
-    return min_index
+
+def get_tile_averages(image, size):
+    """Average (r, g, b) of every tile of a grid of m rows * n columns.
+
+    The image is converted to one array and the tiles are summed with one
+    block reduction per axis; returns an (m, n, 3) array. Tiles are laid
+    out as in split_image.
+    """
+    m, n = size
+    check_grid_size(image.size, size)
+    im = np.asarray(image.convert('RGB'))
+    ys, xs = tile_edges(im.shape[0], m), tile_edges(im.shape[1], n)
+    # Sum the rows of each band of tiles, then the columns of each tile
+    sums = np.add.reduceat(im, ys[:-1], axis=0, dtype=np.uint32)
+    sums = np.add.reduceat(sums, xs[:-1], axis=1, dtype=np.uint64)
+    counts = np.diff(ys)[:, None] * np.diff(xs)[None, :]
+    return sums / counts[:, :, None]
 
 
 def create_image_grid(images, dims):
@@ -91,40 +125,90 @@ def create_image_grid(images, dims):
     return grid_img
 
 
-def create_photomosaic(target_image, input_images, grid_size, reuse_images=True):
-    """Create a photomosaic given target and input images."""
+def match_tiles(target_image, input_images, grid_size, reuse_images=True,
+                input_avgs=None, features='rgb', cells=1):
+    """Index of the input image of every tile, in row-major order.
+
+    input_avgs optionally holds the average colors of the input images,
+    e.g. from the tile index, so they are not computed again. With cells > 1
+    tiles and images are matched on a cells x cells grid of colors instead
+    of their average, with features 'lab' in CIE Lab rather than RGB (see
+    features.py).
+    """
+    m, n = grid_size
     print("splitting input images...")
-    target_images = split_image(target_image, grid_size)
+    if features == 'rgb' and cells == 1:
+        # Average color of every target tile, in row-major order
+        target_avgs = get_tile_averages(target_image, grid_size).reshape(-1, 3)
+    else:
+        # Colors of the cells of every tile
+        target_avgs = tile_features(get_tile_averages(target_image, (m*cells, n*cells)),
+                                    grid_size, cells, features)
 
     print("finding image matches...")
-    # For each tile, pick one matching input files
-    output_images = []
-    # For user feedback
-    count = 0
-
     # Calculate the average of the input images
-    avgs = []
-    for img in input_images:
-        avgs.append(get_average_RGB(img))
-
-    for img in target_images:
-        avg = get_average_RGB(img)
-        # Find the matching index of closest RGB value
-        match_index = get_best_match_index(avg, avgs)
-        match = input_images[match_index]
-        output_images.append(match)
-        count += 1
-
-        # Remove the selected image from input if flag set
-        if not reuse_images:
-            input_images.remove(match)
-
-    print("creating mosaic...")
-    # Create photomosaic image from files
-    mosaic_image = create_image_grid(output_images, grid_size)
-
-    # display the mosaic
-    return mosaic_image
+    if features != 'rgb' or cells > 1:
+        avgs = image_features(input_images, cells, features)
+    elif input_avgs is None:
+        avgs = np.array([get_average_RGB(img) for img in input_images])
+    else:
+        avgs = np.asarray(input_avgs, np.float64)
+
+    if reuse_images:
+        # Match all tiles in one batched nearest-neighbour query
+        return TileMatcher(avgs).nearest(target_avgs)
+    # Give each tile a different input file, assigned over all tiles at once
+    return assign_unique(target_avgs, avgs)
+
+
+def tile_size_for(image_size, grid_size):
+    """Largest (width, height) of the tiles of an image cut into grid_size."""
+    return int(image_size[0]/grid_size[1]), int(image_size[1]/grid_size[0])
+
+
+def write_mosaic(input_images, match_indices, grid_size, output_filename,
+                 output_mode='image'):
+    """Write the mosaic of the matched input images; return the path written.
+
+    output_mode 'image' builds the mosaic in memory and saves it as a PNG,
+    'bands' streams it to the PNG one row of tiles at a time and 'deepzoom'
+    writes a DeepZoom tile pyramid (see mosaicwriter.py).
+    """
+    if output_mode == 'image':
+        print("creating mosaic...")
+        mosaic_image = create_image_grid(
+            [input_images[index] for index in match_indices.tolist()], grid_size)
+        mosaic_image.save(output_filename, 'PNG')
+        return output_filename
+    # Render and write one row of tiles at a time
+    bands = MosaicBands(input_images, match_indices, grid_size)
+    print(f"writing {bands.size[0]}x{bands.size[1]} mosaic...")
+    if output_mode == 'deepzoom':
+        return write_deepzoom(output_filename, bands.size, bands)
+    write_png(output_filename, bands.size, bands)
+    return output_filename
+
+
+def add_mosaic_arguments(parser):
+    """Options shared by photomosaic.py and batch.py."""
+    parser.add_argument('--input-folder', dest='input_folder', required=True)
+    parser.add_argument('--grid-size', nargs=2,
+                        dest='grid_size', required=True)
+    parser.add_argument('--no-index', dest='use_index', action='store_false',
+                        help="Decode every input image instead of using the tile index")
+    parser.add_argument('--no-reuse', dest='reuse_images', action='store_false',
+                        help="Use every input image at most once")
+    parser.add_argument('--features', dest='features', choices=FEATURES, default='rgb',
+                        help="Color space tiles are matched in")
+    parser.add_argument('--feature-grid', dest='cells', type=int, choices=[1, 2, 4],
+                        default=1, help="Match on an NxN grid of colors per tile")
+    parser.add_argument('--output-mode', dest='output_mode',
+                        choices=['image', 'bands', 'deepzoom'], default='image',
+                        help="Build the mosaic in memory (image), stream it to the PNG "
+                             "one row of tiles at a time (bands) or write a DeepZoom "
+                             "tile pyramid (deepzoom)")
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None,
+                        help="Processes decoding input images (default: one per CPU)")
 
 
 def main():
@@ -132,28 +216,45 @@ def main():
     parser = argparse.ArgumentParser(
         description="Creates a photomosaic from input images.")
     parser.add_argument('--target-image', dest='target_image', required=True)
-    parser.add_argument('--input-folder', dest='input_folder', required=True)
-    parser.add_argument('--grid-size', nargs=2,
-                        dest='grid_size', required=True)
     parser.add_argument('--output-file', dest='outfile', required=False)
+    add_mosaic_arguments(parser)
 
     args = parser.parse_args()
 
     target_image = Image.open(args.target_image)
 
+    # Size of the grid
+    grid_size = (int(args.grid_size[0]), int(args.grid_size[1]))
+    try:
+        check_grid_size(target_image.size, grid_size)
+    except ValueError as e:
+        print(e)
+        exit(1)
+    # For given grid size (rows, columns), compute the max width and height of tiles
+    tile_dims = tile_size_for(target_image.size, grid_size)
+
     # input images
     print('reading input folder...')
-    input_images = get_images(args.input_folder)
+    input_avgs = None
+    if args.use_index:
+        # Averages and thumbnails of unchanged images come from the index
+        index = update_index(args.input_folder, tile_dims, jobs=args.jobs)
+        input_images = index.images(tile_dims)
+        input_avgs = index.averages[index.valid]
+    else:
+        # Decode straight to tile size thumbnails
+        input_images = get_images(args.input_folder, tile_dims, args.jobs)
     # Check if any valid input images found
     if input_images == []:
         print(f"No input images found in {args.input_folder}")
         exit()
 
     # Shuffle list to get more varied output
-    random.shuffle(input_images)
-
-    # Size of the grid
-    grid_size = (int(args.grid_size[0]), int(args.grid_size[1]))
+    order = list(range(len(input_images)))
+    random.shuffle(order)
+    input_images = [input_images[i] for i in order]
+    if input_avgs is not None:
+        input_avgs = input_avgs[order]
 
     # Output
     output_filename = 'mosaic.png'
@@ -161,42 +262,25 @@ def main():
         output_filename = args.outfile
 
     # Reuse any image in input
-    reuse_images = True
-    # Resize the input to fit the original image size
-    resize_input = True
+    reuse_images = args.reuse_images
 
     print('starting photomosaic creation...')
     # If images can't be reused, ensure m*n <= num_of_images
     if not reuse_images:
         if grid_size[0]*grid_size[1] > len(input_images):
-            print("Grid size less than number of images.")
+            print(f"Not enough input images ({len(input_images)}) for a "
+                  f"{grid_size[0]}x{grid_size[1]} grid without reuse.")
             exit()
 
-    # Resizing input
-    if resize_input:
-        print("resizing images...")
-        # For given grid size,  compute the max width and height of tiles
-        tile_dims = (
-            int(target_image.size[0]/grid_size[0]), int(target_image.size[1]/grid_size[1]))
-        print(f"max tile dims: {tile_dims}")
-        # resize
-        for img in input_images:
-            img.thumbnail(tile_dims)
-
-    # Create photomosaic
-    mosaic_image = create_photomosaic(
-        target_image, input_images, grid_size, reuse_images)
+    match_indices = match_tiles(target_image, input_images, grid_size, reuse_images,
+                                input_avgs, args.features, args.cells)
 
     # Write out mosaic
-    mosaic_image.save(output_filename, 'PNG')
+    output_filename = write_mosaic(input_images, match_indices, grid_size, output_filename,
+                                   args.output_mode)
     print(f"saved output to {output_filename}")
 
 
 if __name__ == "__main__":
     main()
 
-
-images = get_images('imgs')
-for img in images:
-    a = get_average_RGB(img)
-    print(a)
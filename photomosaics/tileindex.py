@@ -0,0 +1,222 @@
+"""
+tileindex.py
+
+Persistent index of the tile library (the --input-folder).
+
+For every file of the folder the index keeps its size and mtime, its
+average RGB color and optionally a thumbnail. The index is saved next to
+the images; on later runs only files that are new or whose size or mtime
+changed are decoded again, the others come straight from the index. Files
+that are not images are remembered too, so they are not retried on every
+run.
+
+Thumbnails are kept at one size, large enough for every tile size asked
+for so far, and reduced to the tile size of a run when it is smaller. A
+different grid or target therefore reuses them; only a larger tile size
+than any before makes the folder be decoded again (once).
+
+Images are decoded in a process pool, JPEGs directly at a reduced scale
+close to the tile size (Pillow's draft mode), and only the thumbnail and
+its average color are kept, so memory scales with the tile size rather
+than with the size of the source images.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+INDEX_NAME = '.photomosaic-index.npz'
+INDEX_VERSION = 2
+# Size images are reduced to when only their average color is needed
+AVERAGE_SIZE = (64, 64)
+
+
+def load_tile(path, thumb_size=None):
+    """Decode one image; return (average RGB, thumbnail array or None).
+
+    The average is taken over the thumbnail (or over a reduction to
+    AVERAGE_SIZE without thumb_size). Returns None if the file is not a
+    readable image.
+    """
+    size = AVERAGE_SIZE if thumb_size is None else tuple(thumb_size)
+    try:
+        with Image.open(path) as im:
+            # Let JPEGs decode at 1/2..1/8 scale, still no smaller than size
+            im.draft('RGB', size)
+            im = im.convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    im.thumbnail(size)
+    thumbnail = np.asarray(im, np.uint8)
+    average = thumbnail.reshape(-1, 3).mean(axis=0)
+    return average, thumbnail if thumb_size is not None else None
+
+
+def load_tiles(paths, thumb_size=None, jobs=None):
+    """load_tile for many files, in a process pool when jobs > 1.
+
+    jobs defaults to one worker per CPU.
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(paths))
+    if jobs <= 1:
+        return [load_tile(path, thumb_size) for path in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(load_tile, paths, [thumb_size] * len(paths),
+                             chunksize=max(len(paths) // (4 * jobs), 1)))
+
+
+class TileIndex:
+    """Average colors (and thumbnails) of the images of a folder."""
+
+    def __init__(self, names, sizes, mtimes, averages, thumb_size=None, thumbnails=None):
+        self.names = list(names)  # file names, in sorted order
+        self.sizes = np.asarray(sizes, np.int64)
+        self.mtimes = np.asarray(mtimes, np.int64)  # st_mtime_ns
+        # (N, 3) average colors, NaN for files that are not images
+        self.averages = np.asarray(averages, np.float64).reshape(-1, 3)
+        # Thumbnails fit in thumb_size, one (h, w, 3) array per file (None
+        # for files that are not images)
+        self.thumb_size = None if thumb_size is None else tuple(thumb_size)
+        self.thumbnails = thumbnails
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def valid(self):
+        """Boolean mask of the entries that are images."""
+        return ~np.isnan(self.averages[:, 0])
+
+    def images(self, thumb_size=None):
+        """Thumbnails of the valid entries as PIL images.
+
+        With thumb_size, thumbnails larger than it are reduced to fit.
+        """
+        images = []
+        for thumbnail, valid in zip(self.thumbnails, self.valid):
+            if valid:
+                image = Image.fromarray(thumbnail)
+                if thumb_size is not None:
+                    image.thumbnail(thumb_size)
+                images.append(image)
+        return images
+
+    def save(self, path):
+        """Write the index to an .npz file."""
+        arrays = {'version': np.array(INDEX_VERSION), 'names': np.array(self.names, str),
+                  'sizes': self.sizes, 'mtimes': self.mtimes, 'averages': self.averages}
+        if self.thumbnails is not None:
+            thumbnails = [np.zeros((0, 0, 3), np.uint8) if thumbnail is None else thumbnail
+                          for thumbnail in self.thumbnails]
+            arrays['thumb_size'] = np.array(self.thumb_size, np.int64)
+            arrays['thumb_shapes'] = np.array([t.shape[:2] for t in thumbnails],
+                                              np.int64).reshape(-1, 2)
+            arrays['thumb_data'] = np.concatenate([t.reshape(-1) for t in thumbnails]) \
+                if thumbnails else np.zeros(0, np.uint8)
+        # Write to a temporary file first so a crash never leaves a bad index
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by save()."""
+        with np.load(path) as data:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError(f"Unsupported tile index version in {path}")
+            thumb_size, thumbnails = None, None
+            if 'thumb_size' in data:
+                thumb_size = tuple(data['thumb_size'].tolist())
+                shapes = data['thumb_shapes']
+                ends = np.cumsum(shapes[:, 0] * shapes[:, 1] * 3)
+                thumbnails = [None if h == 0 else chunk.reshape(h, w, 3)
+                              for chunk, (h, w) in zip(np.split(data['thumb_data'], ends[:-1]),
+                                                       shapes.tolist())]
+            return cls(data['names'].tolist(), data['sizes'], data['mtimes'],
+                       data['averages'], thumb_size, thumbnails)
+
+
+def index_path_for(image_dir):
+    """Path of the index file kept in an image folder."""
+    return os.path.join(image_dir, INDEX_NAME)
+
+
+def _fits(size, container):
+    return size[0] <= container[0] and size[1] <= container[1]
+
+
+def update_index(image_dir, thumb_size=None, use_cache=True, jobs=None):
+    """Return the TileIndex of a folder, decoding only new or changed files.
+
+    With thumb_size, the index holds thumbnails at least that large (see
+    TileIndex.images to reduce them). Saved thumbnails that are smaller
+    are regenerated at a size covering both; averages of unchanged files
+    are always reused. New or changed files are decoded by jobs worker
+    processes (default: one per CPU). The updated index is saved unless
+    use_cache is False.
+    """
+    path = index_path_for(image_dir)
+    old = None
+    if use_cache and os.path.exists(path):
+        try:
+            old = TileIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            # Unreadable index: rebuild it below
+            pass
+    known, old_thumbs = {}, False
+    if old is not None:
+        known = {name: i for i, name in enumerate(old.names)}
+        if old.thumbnails is not None:
+            # Keep the saved thumbnails when they are large enough, else
+            # make new ones fitting both sizes
+            if thumb_size is None or _fits(thumb_size, old.thumb_size):
+                thumb_size, old_thumbs = old.thumb_size, True
+            else:
+                thumb_size = (max(thumb_size[0], old.thumb_size[0]),
+                              max(thumb_size[1], old.thumb_size[1]))
+    thumb_size = None if thumb_size is None else tuple(thumb_size)
+
+    names, sizes, mtimes, averages, thumbnails = [], [], [], [], []
+    # Positions and paths of the files to decode
+    pending, paths = [], []
+    for name in sorted(os.listdir(image_dir)):
+        file_path = os.path.join(image_dir, name)
+        if name.startswith('.') or not os.path.isfile(file_path):
+            continue
+        st = os.stat(file_path)
+        i = known.get(name)
+        unchanged = i is not None and old.sizes[i] == st.st_size and \
+            old.mtimes[i] == st.st_mtime_ns
+        if unchanged and np.isnan(old.averages[i, 0]):
+            # Still not an image
+            averages.append(old.averages[i])
+            thumbnails.append(None)
+        elif unchanged and (thumb_size is None or old_thumbs):
+            averages.append(old.averages[i])
+            thumbnails.append(old.thumbnails[i] if old_thumbs else None)
+        else:
+            pending.append(len(names))
+            paths.append(file_path)
+            averages.append(None)
+            thumbnails.append(None)
+        names.append(name)
+        sizes.append(st.st_size)
+        mtimes.append(st.st_mtime_ns)
+    decoded = len(paths)
+    for position, file_path, tile in zip(pending, paths, load_tiles(paths, thumb_size, jobs)):
+        if tile is None:
+            print(f"Invalid image: {os.path.abspath(file_path)}")
+            averages[position] = np.full(3, np.nan)
+        else:
+            averages[position], thumbnails[position] = tile
+    index = TileIndex(names, sizes, mtimes, np.array(averages).reshape(-1, 3), thumb_size,
+                      thumbnails if thumb_size is not None else None)
+    print(f"tile index: {len(names) - decoded} cached, {decoded} decoded")
+    if use_cache and (decoded or old is None or len(old) != len(index)):
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"Could not save the tile index to {path}: {e}")
+    return index